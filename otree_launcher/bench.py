@@ -0,0 +1,552 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# =============================================================================
+# FUTURE
+# =============================================================================
+
+from __future__ import unicode_literals
+
+
+# =============================================================================
+# DOCS
+# =============================================================================
+
+__doc__ = """Benchmarks for oTree launcher
+
+Usage: python -m otree_launcher.bench <benchmark> [options]
+
+startup: every measure is taken in a fresh interpreter. *cold* runs use a
+    new empty launcher directory each time, *warm* runs reuse a directory
+    already used by a previous run.
+
+console: lines per second rendered by the gui console handler compared
+    with the old one-redraw-per-record handler (needs a display).
+
+venv: seconds to populate a virtualenv (without setuptools nor pip) with
+    the bundled virtualenv.py copying file by file and with --bulk, both
+    symlinking and with --always-copy.
+
+"""
+
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import os
+import sys
+import json
+import time
+import types
+import logging
+import shutil
+import argparse
+import re
+import tempfile
+import subprocess
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+PKG_PARENT_PATH = os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))
+)
+
+RESULT_MARK = "@@BENCH@@"
+
+STARTUP_MODULES = ("cons", "db", "core", "gui")
+
+STARTUP_METRICS = tuple(
+    ["import " + mod for mod in STARTUP_MODULES] + ["gui.run", "process"]
+)
+
+TK_MODULES = ("Tkinter", "ttk", "tkMessageBox", "tkFileDialog")
+
+VIRTUALENV_PATH = os.path.join(
+    PKG_PARENT_PATH, "otree_launcher", "res", "packages", "virtualenv",
+    "virtualenv.py"
+)
+
+VENV_MODES = (
+    ("file by file", []),
+    ("bulk", ["--bulk"]),
+    ("file by file, copy", ["--always-copy"]),
+    ("bulk, copy", ["--always-copy", "--bulk"]),
+)
+
+POPULATED_PATTERN = re.compile(
+    r"Populated (\d+) files \((\d+) bytes\) in ([\d.]+)s")
+
+
+# =============================================================================
+# TK STUB
+# =============================================================================
+
+class TkStub(object):
+    """Accept any attribute access, call or arithmetic operation.
+
+    Used to replace every Tkinter class when no display is available
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return TkStub()
+
+    def __call__(self, *args, **kwargs):
+        return TkStub()
+
+    def __int__(self):
+        return 0
+
+    def __iter__(self):
+        return iter(())
+
+    def _zero(self, other):
+        return 0
+
+    __add__ = __radd__ = __sub__ = __rsub__ = _zero
+    __mul__ = __rmul__ = __floordiv__ = __rfloordiv__ = _zero
+
+    def mainloop(self, *args, **kwargs):
+        pass
+
+
+class TkStubModule(types.ModuleType):
+    """A module where every attribute is the TkStub class"""
+
+    __all__ = []
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return TkStub
+
+
+def install_tk_stub():
+    """Replace all the Tkinter modules used by the launcher with stubs"""
+    for name in TK_MODULES:
+        sys.modules[name] = TkStubModule(str(name))
+
+
+class FinishedProc(object):
+    """Looks like a Popen already finished without errors"""
+
+    pid = 0
+    returncode = 0
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        return self.returncode
+
+
+# =============================================================================
+# CHILD SIDE
+# =============================================================================
+
+def startup_child(tk_mode):
+    """Measure the startup of the launcher in this (fresh) interpreter and
+    print the result as json preceded by RESULT_MARK
+
+    """
+    if tk_mode == "stub":
+        install_tk_stub()
+
+    result = {}
+    clock = time.time
+    for mod in STARTUP_MODULES:
+        start = clock()
+        __import__("otree_launcher." + mod)
+        result["import " + mod] = clock() - start
+
+    from otree_launcher import cons, core, gui
+
+    # the splash minimum time would hide any regression of the boot
+    cons.SPLASH_MIN_TIME = 0
+
+    # isolate the boot from network, subprocess and modal dialogs
+    core.check_connectivity = lambda *args, **kwargs: None
+    core.check_upgrade = lambda: (cons.str_version(), False, False, False)
+    core.create_virtualenv = FinishedProc
+    for name in ("showinfo", "showerror", "showwarning",
+                 "askyesno", "askokcancel"):
+        setattr(gui.MessageBox, name, lambda self, *a, **kw: False)
+
+    if tk_mode == "real":
+        # quit on the first idle tick of the mainloop
+        Tk = sys.modules["Tkinter"].Tk
+        original_mainloop = Tk.mainloop
+
+        def mainloop(self, n=0):
+            self.after_idle(self.quit)
+            original_mainloop(self, n)
+
+        Tk.mainloop = mainloop
+
+    start = clock()
+    gui.run()
+    result["gui.run"] = clock() - start
+
+    sys.stdout.write(RESULT_MARK + json.dumps(result) + "\n")
+    sys.stdout.flush()
+
+
+# =============================================================================
+# PARENT SIDE
+# =============================================================================
+
+def median(values):
+    values = sorted(values)
+    size = len(values)
+    if not size:
+        return None
+    middle = size // 2
+    if size % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.
+
+
+def run_child(home, tk_mode):
+    """Run startup_child in a new interpreter with *home* as home directory
+    and return the measures
+
+    """
+    env = dict(os.environ)
+    env.update({
+        str("HOME"): str(home), str("APPDATA"): str(home),
+        str("PYTHONPATH"): str(os.pathsep.join(
+            [PKG_PARENT_PATH, env.get(str("PYTHONPATH"), str(""))]
+        ))
+    })
+    code = (
+        "from otree_launcher import bench; bench.startup_child({!r})"
+    ).format(str(tk_mode))
+    start = time.time()
+    proc = subprocess.Popen(
+        [sys.executable, "-c", code], env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    out, err = proc.communicate()
+    elapsed = time.time() - start
+    if proc.returncode:
+        raise RuntimeError(
+            "Benchmark child failed ({}):\n{}".format(proc.returncode, err)
+        )
+    for line in out.decode("utf8", "replace").splitlines():
+        if line.startswith(RESULT_MARK):
+            result = json.loads(line[len(RESULT_MARK):])
+            result["process"] = elapsed
+            return result
+    raise RuntimeError("Benchmark child gives no result:\n{}".format(err))
+
+
+def bench_startup(runs=5, tk_mode="auto"):
+    """Return the cold and warm medians (in ms) of every startup metric
+
+    """
+    if tk_mode == "auto":
+        tk_mode = "real" if os.getenv("DISPLAY") or sys.platform in (
+            "win32", "darwin") else "stub"
+
+    measures = {"cold": [], "warm": []}
+    warm_home = tempfile.mkdtemp(prefix="otree_bench_warm_")
+    try:
+        run_child(warm_home, tk_mode)  # prime the warm directory
+        for _ in range(runs):
+            cold_home = tempfile.mkdtemp(prefix="otree_bench_cold_")
+            try:
+                measures["cold"].append(run_child(cold_home, tk_mode))
+            finally:
+                shutil.rmtree(cold_home, ignore_errors=True)
+            measures["warm"].append(run_child(warm_home, tk_mode))
+    finally:
+        shutil.rmtree(warm_home, ignore_errors=True)
+
+    report = {"tk": tk_mode, "runs": runs}
+    for kind, results in measures.items():
+        report[kind] = {
+            metric: median([r[metric] for r in results]) * 1000.
+            for metric in STARTUP_METRICS
+        }
+    return report
+
+
+def find_regressions(report, baseline, threshold, min_delta):
+    """Compare *report* with *baseline* and return a list of messages for
+    every metric slower than baseline by more than *threshold* (a fraction)
+    and *min_delta* milliseconds
+
+    """
+    regressions = []
+    for kind in ("cold", "warm"):
+        for metric in STARTUP_METRICS:
+            old = baseline.get(kind, {}).get(metric)
+            new = report[kind][metric]
+            if old is None:
+                continue
+            if new > old * (1 + threshold) and new - old > min_delta:
+                regressions.append(
+                    "{} '{}': {:.1f}ms -> {:.1f}ms (+{:.0%})".format(
+                        kind, metric, old, new, (new - old) / old)
+                )
+    return regressions
+
+
+def format_report(report):
+    lines = [
+        "Startup (tk={}, runs={}, medians in ms)".format(
+            report["tk"], report["runs"]),
+        "{:<16}{:>12}{:>12}".format("metric", "cold", "warm")
+    ]
+    for metric in STARTUP_METRICS:
+        lines.append("{:<16}{:>12.1f}{:>12.1f}".format(
+            metric, report["cold"][metric], report["warm"][metric]))
+    return "\n".join(lines)
+
+
+# =============================================================================
+# CONSOLE
+# =============================================================================
+
+class LegacyLoggingToGUI(logging.Handler):
+    """The console handler used until v0.6.1: one insert and a full redraw
+    for every record. Kept only to compare
+
+    """
+
+    def __init__(self, console):
+        super(LegacyLoggingToGUI, self).__init__()
+        self.console = console
+
+    def emit(self, message):
+        import Tkinter
+        self.console.configure(state=Tkinter.NORMAL)
+        self.console.insert(Tkinter.END, "> " + self.format(message) + "\n")
+        self.console.configure(state=Tkinter.DISABLED)
+        self.console.see(Tkinter.END)
+        self.console.update()
+
+
+def rendered_lines(console):
+    """Lines in the Text *console* (every line ends with a newline)"""
+    return int(console.index("end-1c").split(".")[0]) - 1
+
+
+def bench_console(lines=20000, pump_every=100):
+    """Return the lines per second rendered by the old and the current
+    console handler. The Tk loop is pumped every *pump_every* records (as
+    the mainloop would do) and the time runs until every line is in the
+    widget
+
+    """
+    import Tkinter
+    from otree_launcher import gui
+
+    root = Tkinter.Tk()
+    display = gui.LogDisplay(root, max_lines=lines + 1)
+    display.pack(fill=Tkinter.BOTH, expand=True)
+    console = display.console
+    root.update()
+    dispatcher = gui.Dispatcher(root)
+
+    bench_logger = logging.getLogger("otree_launcher.bench.console")
+    bench_logger.propagate = False
+    bench_logger.setLevel(logging.INFO)
+
+    # a buffer of all the lines, so the buffered handler drops none
+    handlers = [
+        ("legacy", LegacyLoggingToGUI(console)),
+        ("buffered", gui.LoggingToGUI(display, dispatcher, size=lines)),
+    ]
+    report = {"lines": lines}
+    for name, handler in handlers:
+        console.configure(state=Tkinter.NORMAL)
+        console.delete("1.0", Tkinter.END)
+        console.configure(state=Tkinter.DISABLED)
+        bench_logger.handlers = [handler]
+
+        start = time.time()
+        for idx in range(lines):
+            bench_logger.info("Collecting package-%d (from -r req.txt)", idx)
+            if not idx % pump_every:
+                root.update()
+        while rendered_lines(console) < lines and getattr(
+                handler, "armed", False):
+            root.update()
+        elapsed = time.time() - start
+        if rendered_lines(console) != lines:
+            raise RuntimeError("The {} handler rendered {} of {} lines".format(
+                name, rendered_lines(console), lines))
+        report[name] = lines / elapsed
+
+    root.destroy()
+    return report
+
+
+# =============================================================================
+# VENV
+# =============================================================================
+
+def create_venv(dest, options):
+    """Run the bundled virtualenv.py and return the seconds it takes and the
+    files, bytes and seconds reported by the bulk populations (added up, or
+    None)
+
+    """
+    start = time.time()
+    proc = subprocess.Popen(
+        [sys.executable, VIRTUALENV_PATH, "--no-setuptools"] + options +
+        [dest], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out = proc.communicate()[0]
+    elapsed = time.time() - start
+    if proc.returncode:
+        raise RuntimeError("virtualenv.py failed:\n{}".format(out))
+    matches = POPULATED_PATTERN.findall(out.decode("utf8", "replace"))
+    populated = tuple(
+        sum(float(match[idx]) for match in matches) for idx in range(3)
+    ) if matches else None
+    return elapsed, populated
+
+
+def bench_venv(runs=5, base_dir=None):
+    """Return the median seconds of every mode in VENV_MODES and the files
+    and bytes per second of the bulk population
+
+    """
+    report = {"runs": runs, "modes": []}
+    for name, options in VENV_MODES:
+        times, rates = [], []
+        for _ in range(runs):
+            tmp = tempfile.mkdtemp(prefix="otree_bench_venv_", dir=base_dir)
+            try:
+                elapsed, populated = create_venv(
+                    os.path.join(tmp, "venv"), options)
+            finally:
+                shutil.rmtree(tmp, ignore_errors=True)
+            times.append(elapsed)
+            if populated:
+                files, size, seconds = populated
+                rates.append((files / seconds, size / seconds))
+        mode = {"mode": name, "seconds": median(times)}
+        if rates:
+            mode["files_per_sec"] = median([rate[0] for rate in rates])
+            mode["bytes_per_sec"] = median([rate[1] for rate in rates])
+        report["modes"].append(mode)
+    return report
+
+
+# =============================================================================
+# COMMAND LINE
+# =============================================================================
+
+def cmd_startup(args):
+    report = bench_startup(args.runs, args.tk)
+    print(format_report(report))
+
+    if args.save:
+        with open(args.save, "w") as fp:
+            json.dump(report, fp, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        regressions = find_regressions(
+            report, baseline, args.threshold, args.min_delta)
+        if regressions:
+            print("REGRESSIONS:\n  " + "\n  ".join(regressions))
+            return 1
+        print("No regressions against '{}'".format(args.baseline))
+    return 0
+
+
+def cmd_console(args):
+    try:
+        report = bench_console(args.lines)
+    except Exception as err:
+        print("The console benchmark fails (needs a display): {}".format(
+            err))
+        return 2
+    print("Console ({} lines)".format(report["lines"]))
+    print("{:<16}{:>12.0f} lines/s".format("legacy", report["legacy"]))
+    print("{:<16}{:>12.0f} lines/s ({:.1f}x)".format(
+        "buffered", report["buffered"], report["buffered"] / report["legacy"]))
+    return 0
+
+
+def cmd_venv(args):
+    report = bench_venv(args.runs, args.dir)
+    print("Virtualenv population (runs={}, medians)".format(report["runs"]))
+    print("{:<22}{:>10}{:>14}{:>12}".format(
+        "mode", "seconds", "files/s", "MB/s"))
+    for mode in report["modes"]:
+        print("{:<22}{:>10.3f}{:>14}{:>12}".format(
+            mode["mode"], mode["seconds"],
+            "{:.0f}".format(mode["files_per_sec"])
+            if "files_per_sec" in mode else "-",
+            "{:.1f}".format(mode["bytes_per_sec"] / 1024 / 1024)
+            if "bytes_per_sec" in mode else "-"))
+    return 0
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="python -m otree_launcher.bench", description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="bench")
+
+    startup = subparsers.add_parser(
+        "startup", help="time the imports and the gui boot")
+    startup.add_argument("--runs", type=int, default=5,
+                         help="cold and warm runs (default: 5)")
+    startup.add_argument("--tk", choices=["auto", "real", "stub"],
+                         default="auto",
+                         help="use the real Tk or a stub (default: auto)")
+    startup.add_argument("--save", metavar="FILE",
+                         help="store the report as json")
+    startup.add_argument("--baseline", metavar="FILE",
+                         help="compare against a report saved with --save")
+    startup.add_argument("--threshold", type=float, default=0.25,
+                         help="allowed slowdown fraction (default: 0.25)")
+    startup.add_argument("--min-delta", type=float, default=5.,
+                         help="ignore slowdowns under this ms (default: 5)")
+    startup.set_defaults(func=cmd_startup)
+
+    console = subparsers.add_parser(
+        "console", help="lines per second rendered by the gui console")
+    console.add_argument("--lines", type=int, default=20000,
+                         help="lines to render (default: 20000)")
+    console.set_defaults(func=cmd_console)
+
+    venv = subparsers.add_parser(
+        "venv", help="virtualenv population file by file against --bulk")
+    venv.add_argument("--runs", type=int, default=5,
+                      help="runs of every mode (default: 5)")
+    venv.add_argument("--dir", metavar="DIR",
+                      help="create the virtualenvs here (default: the temp "
+                           "directory), try other filesystems")
+    venv.set_defaults(func=cmd_venv)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    return args.func(args)
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,438 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# =============================================================================
+# FUTURE
+# =============================================================================
+
+from __future__ import unicode_literals
+
+
+# =============================================================================
+# DOCS
+# =============================================================================
+
+__doc__ = """Command line interface for oTree launcher
+
+Usage: python -m otree_launcher.cli <command> [options]
+
+Never imports Tkinter. Every command writes a json document to stdout and
+exits with one of the EXIT_* codes; the log goes to stderr.
+
+"""
+
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import os
+import sys
+import json
+import time
+import argparse
+import functools
+
+from . import cons, core, db, monitor
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+logger = cons.logger
+
+# : Everything gone well
+EXIT_OK = 0
+
+# : An external command finished with an error
+EXIT_FAILED = 1
+
+# : Bad arguments (same code used by argparse)
+EXIT_USAGE = 2
+
+# : The launcher itself fails (network, filesystem, etc)
+EXIT_ERROR = 3
+
+# : Stopped by the user
+EXIT_INTERRUPTED = 130
+
+
+# =============================================================================
+# EXCEPTIONS
+# =============================================================================
+
+class UsageError(Exception):
+    pass
+
+
+# =============================================================================
+# HELPERS
+# =============================================================================
+
+def wait(proc):
+    """Wait until *proc* ends, killing it if the user interrupts"""
+    try:
+        return proc.wait()
+    except KeyboardInterrupt:
+        if proc.poll() is None:
+            core.kill_proc(proc)
+        raise
+
+
+def run_step(name, func, *args):
+    """Run the core function *func* and wait for the process that returns
+
+    Returns a dict with the *name* of the step, the return code, the
+    duration in seconds, the record of every command executed and the
+    *report* of the runner (if has one)
+
+    """
+    start = time.time()
+    proc = func(*args)
+    returncode = wait(proc)
+    step = {
+        "step": name, "returncode": returncode,
+        "duration": round(time.time() - start, 3),
+        "commands": getattr(proc, "records", [])
+    }
+    if getattr(proc, "report", None) is not None:
+        step["report"] = proc.report
+    return step
+
+
+def show_output(source, timestamp, line):
+    """Output subscriber that writes the lines of the processes to stderr"""
+    sys.stderr.write(line.encode(cons.ENCODING) + b"\n")
+
+
+def resolve_path(path, conf):
+    """Return the absolute path of the deploy or the configured one"""
+    path = path or conf.path
+    if not path:
+        raise UsageError("No deploy path given and no deploy configured")
+    return os.path.abspath(path)
+
+
+# =============================================================================
+# COMMANDS
+# =============================================================================
+
+def cmd_create_virtualenv(args, conf):
+    steps = [run_step("create_virtualenv", core.create_virtualenv,
+                      not args.no_restore)]
+    if not steps[-1]["returncode"]:
+        conf.virtualenv = True
+        conf.save()
+    return {"path": cons.LAUNCHER_VENV_PATH, "steps": steps}
+
+
+def cmd_snapshot(args, conf):
+    """Store the launcher virtualenv in its snapshot (or restore it from
+    there with --restore)
+
+    """
+    if args.restore:
+        if not core.snapshot_usable():
+            raise UsageError("No usable snapshot in '{}'".format(
+                cons.VENV_SNAPSHOT_PATH))
+        report = core.restore_launcher_venv()
+    else:
+        if not core.venv_ok():
+            raise UsageError("No virtualenv in '{}'".format(
+                cons.LAUNCHER_VENV_PATH))
+        report = core.snapshot_venv(
+            cons.LAUNCHER_VENV_PATH, cons.VENV_SNAPSHOT_PATH)
+    report["duration"] = round(report["duration"], 3)
+    return {"path": cons.VENV_SNAPSHOT_PATH, "snapshot": report,
+            "steps": []}
+
+
+def cmd_clone(args, conf):
+    wrkpath = os.path.abspath(args.path)
+    step = run_step("clone", core.clone, wrkpath, args.depth or None,
+                    args.branch, args.tag)
+    if "report" in step:
+        step["report"]["duration"] = round(step["report"]["duration"], 3)
+    return {"path": wrkpath, "steps": [step]}
+
+
+def cmd_install_requirements(args, conf):
+    wrkpath = resolve_path(args.path, conf)
+    return {
+        "path": wrkpath,
+        "steps": [run_step("install_requirements", core.install_requirements,
+                           wrkpath, args.force, args.isolated)]
+    }
+
+
+def cmd_prefetch(args, conf):
+    """Download concurrently the pinned requirements of a deploy into the
+    wheelhouse (or --dest)
+
+    """
+    wrkpath = resolve_path(args.path, conf)
+    report = core.prefetch(
+        os.path.join(wrkpath, cons.REQUIREMENTS_FNAME), dest=args.dest,
+        index_url=args.index_url, workers=args.workers)
+    report["duration"] = round(report["duration"], 3)
+    return {"path": wrkpath, "prefetch": report, "steps": [
+        {"step": "prefetch", "returncode": 1 if report["failed"] else 0}
+    ]}
+
+
+def cmd_reset_db(args, conf):
+    wrkpath = resolve_path(args.path, conf)
+    return {"path": wrkpath,
+            "steps": [run_step("reset_db", core.reset_db, wrkpath)]}
+
+
+def stats_path(fpath, server, count):
+    """The csv file of *server*; with many servers the port is added"""
+    if count == 1:
+        return fpath
+    base, ext = os.path.splitext(fpath)
+    return "{}-{}{}".format(base, server.port, ext or ".csv")
+
+
+def cmd_runserver(args, conf):
+    """Run the server of every deploy given (each one in a free port) and
+    wait until all of them end
+
+    """
+    paths = [resolve_path(path, conf) for path in args.paths or [None]]
+    if args.port and len(paths) > 1:
+        raise UsageError("--port can't be used with many deploys")
+    if args.port and core.port_in_use(args.port):
+        raise UsageError("Port {} is already in use".format(args.port))
+    pool = core.ServerPool()
+    ready = core.TaskRunner()
+    steps = []
+    try:
+        for path in paths:
+            server = pool.start(path, args.port)
+            ready.add(path, server.wait_ready, critical=False)
+            if args.stats:
+                server.sampler = monitor.ResourceSampler(
+                    server.proc, interval=args.stats_interval).start()
+        for server in list(pool.servers.values()):
+            returncode = server.proc.wait()
+            pool.discard(server)
+            steps.append({
+                "step": "runserver", "path": server.path,
+                "port": server.port, "returncode": returncode,
+                "ready": ready.result(server.path),
+                "duration": round(time.time() - server.started, 3),
+                "commands": server.proc.records
+            })
+            if server.sampler is not None:
+                steps[-1]["stats"] = stats_path(args.stats, server, len(paths))
+                server.sampler.to_csv(steps[-1]["stats"])
+    except KeyboardInterrupt:
+        for server in filter(None, pool.stop_all()):
+            if server.sampler is not None:
+                server.sampler.to_csv(
+                    stats_path(args.stats, server, len(paths)))
+        raise
+    return {"path": paths[0], "steps": steps}
+
+
+def cmd_servers(args, conf):
+    """The known deploys with their port and the pid of the server if is
+    running (started by this or other launcher)
+
+    """
+    deploys = []
+    for deploy in db.deploys():
+        running = core.is_server(deploy.pid, deploy.port, deploy.started)
+        deploys.append({
+            "path": deploy.path, "port": deploy.port,
+            "pid": deploy.pid if running else None, "running": running,
+            "url": cons.OTREE_URL_TEMPLATE.format(port=deploy.port)
+            if deploy.port else None
+        })
+    return {"path": conf.path, "deploys": deploys, "steps": []}
+
+
+def cmd_stop(args, conf):
+    """Stop the servers of the given deploys (or all with --all): SIGTERM,
+    wait, SIGKILL if still alive and wait the port to be free
+
+    """
+    if args.all:
+        paths = [deploy.path for deploy in db.deploys()]
+    else:
+        paths = [resolve_path(path, conf) for path in args.paths or [None]]
+    stopped = []
+    for path in paths:
+        deploy = db.get_deploy(path)
+        if deploy is None or not deploy.pid:
+            continue
+        # the pid stored can be now of other process: only clear the row
+        if core.is_server(deploy.pid, deploy.port, deploy.started):
+            report = core.stop_group(
+                deploy.pid, grace=args.grace, kill_grace=args.kill_grace,
+                port=deploy.port)
+            report.update(path=path, pid=deploy.pid, port=deploy.port)
+            report["duration"] = round(report["duration"], 3)
+            stopped.append(report)
+        deploy.pid = deploy.started = None
+        deploy.save()
+    return {"path": conf.path, "stopped": stopped, "steps": []}
+
+
+def cmd_deploy(args, conf):
+    """Clone, install (in its own virtualenv) and reset a new deploy and
+    select it as the current one (the same as 'New Deploy' in the gui)
+
+    """
+    wrkpath = os.path.abspath(args.path)
+    if os.path.isdir(wrkpath) and os.listdir(wrkpath):
+        raise UsageError("'{}' is not empty".format(wrkpath))
+    steps = []
+    install = functools.partial(core.install_requirements, isolated=True)
+    for name, func in [("clone", core.clone),
+                       ("install_requirements", install),
+                       ("reset_db", core.reset_db)]:
+        steps.append(run_step(name, func, wrkpath))
+        if steps[-1]["returncode"]:
+            break
+    else:
+        conf.path = wrkpath
+        conf.save()
+        db.get_deploy(wrkpath, create=True)
+    return {"path": wrkpath, "steps": steps}
+
+
+def cmd_status(args, conf):
+    return {
+        "path": conf.path, "virtualenv": conf.virtualenv,
+        "version": cons.str_version(), "venv": cons.LAUNCHER_VENV_PATH,
+        "deploy_venv": core.deploy_venv(conf.path) if conf.path else None,
+        "steps": []
+    }
+
+
+# =============================================================================
+# COMMAND LINE
+# =============================================================================
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="python -m otree_launcher.cli", description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command")
+
+    def add(name, func, help, path=None):
+        sub = subparsers.add_parser(name, help=help)
+        if path == "required":
+            sub.add_argument("path", help="deploy directory")
+        elif path == "optional":
+            sub.add_argument("path", nargs="?",
+                             help="deploy directory (default: the current)")
+        elif path == "many":
+            sub.add_argument("paths", nargs="*", metavar="path",
+                             help="deploy directories (default: the current)")
+        sub.set_defaults(func=func)
+        return sub
+
+    add("status", cmd_status, "show the launcher configuration")
+    create = add("create-virtualenv", cmd_create_virtualenv,
+                 "create the oTree virtualenv")
+    create.add_argument(
+        "--no-restore", action="store_true",
+        help="build it even if there is a snapshot to restore")
+    snapshot = add("snapshot", cmd_snapshot,
+                   "snapshot the oTree virtualenv (or restore it)")
+    snapshot.add_argument("--restore", action="store_true",
+                          help="restore the virtualenv from the snapshot")
+    clone = add("clone", cmd_clone, "clone oTree into a directory",
+                "required")
+    clone.add_argument(
+        "--depth", type=int, default=cons.CLONE_DEPTH,
+        help="commits of history to fetch, 0 for all (default: %(default)s)")
+    ref = clone.add_mutually_exclusive_group()
+    ref.add_argument("--branch", default=cons.CLONE_BRANCH,
+                     help="branch to clone instead of the default one")
+    ref.add_argument("--tag", help="tag to clone")
+    install = add("install-requirements", cmd_install_requirements,
+                  "install the requirements of a deploy", "optional")
+    install.add_argument(
+        "--force", action="store_true",
+        help="install even if nothing changed since the last install")
+    install.add_argument(
+        "--isolated", action="store_true",
+        help="give the deploy its own virtualenv (a clone of the launcher "
+             "one) before install")
+    prefetch = add("prefetch", cmd_prefetch,
+                   "download the pinned requirements of a deploy", "optional")
+    prefetch.add_argument(
+        "--index-url", default=cons.PREFETCH_INDEX_URL,
+        help="simple index to download from (default: %(default)s)")
+    prefetch.add_argument(
+        "--workers", type=int, default=cons.PREFETCH_WORKERS,
+        help="parallel downloads (default: %(default)s)")
+    prefetch.add_argument(
+        "--dest", metavar="DIR",
+        help="directory for the files (default: the wheelhouse)")
+    add("reset-db", cmd_reset_db, "reset the database of a deploy",
+        "optional")
+    runserver = add("runserver", cmd_runserver,
+                    "run the servers of one or more deploys", "many")
+    runserver.add_argument(
+        "--port", type=int,
+        help="port of the server (default: the last used or a free one)")
+    runserver.add_argument(
+        "--stats", metavar="FILE",
+        help="sample the resources used by the server and save them as csv "
+             "(linux only)")
+    runserver.add_argument(
+        "--stats-interval", type=float, default=cons.SAMPLER_INTERVAL,
+        help="seconds between samples (default: %(default)s)")
+    add("deploy", cmd_deploy,
+        "clone, install and reset a new deploy and select it", "required")
+    add("servers", cmd_servers, "list the deploys and their servers")
+    stop = add("stop", cmd_stop, "stop the servers of one or more deploys",
+               "many")
+    stop.add_argument("--all", action="store_true",
+                      help="stop the servers of all the deploys")
+    stop.add_argument(
+        "--grace", type=float, default=cons.STOP_GRACE,
+        help="seconds to wait before kill the server (default: %(default)s)")
+    stop.add_argument(
+        "--kill-grace", type=float, default=cons.STOP_KILL_GRACE,
+        help="seconds to wait after the kill (default: %(default)s)")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    core.OUTPUT.subscribe(show_output)
+    logger.addHandler(core.LogWriterHandler(core.LOG_WRITER))
+    result = {"command": args.command}
+    try:
+        result.update(args.func(args, core.get_conf()))
+    except UsageError as err:
+        result["error"], code = unicode(err), EXIT_USAGE
+    except KeyboardInterrupt:
+        result["error"], code = "interrupted", EXIT_INTERRUPTED
+    except Exception as err:
+        logger.exception(err)
+        result["error"], code = unicode(err), EXIT_ERROR
+    else:
+        failed = any(step["returncode"] for step in result["steps"])
+        code = EXIT_FAILED if failed else EXIT_OK
+    result["exit_code"] = code
+    result["log"] = cons.LOG_FPATH
+    sys.stdout.write(json.dumps(result, indent=2) + "\n")
+    return code
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -26,6 +26,7 @@ import os
 import logging
 import json
 import datetime
+import subprocess
 
 from . import res
 
@@ -64,18 +65,48 @@ AUTHOR = "The oTree team"
 
 SHORT_DESCRIPTION = DOC.splitlines()[0]
 
-# : The project version as tuple of strings
-with open(res.get("version.json")) as fp:
-    VERSION = tuple(json.load(fp)["version"])
+OTREE_REPO = "https://github.com/oTree-org/oTree.git"
 
-STR_VERSION = __version__ = ".".join(VERSION)
+# the deploys clone only the last CLONE_DEPTH commits (None for the whole
+# history) of CLONE_BRANCH (None for the default branch of OTREE_REPO)
+CLONE_DEPTH = 1
 
-OTREE_REPO = "https://github.com/oTree-org/oTree.git"
+CLONE_BRANCH = None
 
 REQUIREMENTS_FNAME = "requirements_base.txt"
 
 DEFAULT_OTREE_DEMO_URL = "http://localhost:8000/"
 
+# every server gets the first free port from OTREE_PORT
+OTREE_PORT = 8000
+
+OTREE_PORT_RANGE = 100
+
+OTREE_URL_TEMPLATE = "http://localhost:{port}/"
+
+# seconds to wait the pid of a new server before store it
+SERVER_SPAWN_TIMEOUT = 5
+
+# seconds to wait a new server to answer before give up
+SERVER_READY_TIMEOUT = 120
+
+# the readiness probe retries every READY_MIN_DELAY seconds doubling the
+# delay up to READY_MAX_DELAY
+READY_MIN_DELAY = 0.05
+
+READY_MAX_DELAY = 1.0
+
+# seconds to wait a stopped server to end before kill it and to wait it
+# (and the port) after the kill
+STOP_GRACE = 5
+
+STOP_KILL_GRACE = 3
+
+# lines of the django runserver output printed just before start listening
+SERVER_READY_PATTERN = (
+    r"Quit the server with|Starting development server at"
+)
+
 OTREE_SCRIPT_FNAME = "otree"
 
 VENV_REQUIREMENTS_URL = (
@@ -88,14 +119,65 @@ LASTEST_VERSION_URL = (
     "otree_launcher/res/version.json"
 )
 
+# seconds to wait the version file of the last release
+UPGRADE_TIMEOUT = 10
+
 OTREE_LAUNCHER_ZIP_URL = (
     "https://github.com/oTree-org/otree-launcher/archive/master.zip"
 )
 
+# minimum seconds the splash is visible
+SPLASH_MIN_TIME = 1
+
 # this servers are needed to run otree-launcher
 SERVERS = ["https://github.com/", "https://pypi.python.org/"]
 
-GIT_AVAILABLE = os.system("git --version") == 0
+# seconds to wait for all the servers together
+CONNECTIVITY_DEADLINE = 3
+
+# seconds to reuse the last connectivity check if was ok or fails
+CONNECTIVITY_TTL = 5 * 60
+
+CONNECTIVITY_FAIL_TTL = 30
+
+# bytes of wheels kept in the wheelhouse (the least recently used are
+# removed first)
+WHEELHOUSE_MAX_SIZE = 512 * 1024 * 1024
+
+# seconds after which an unfinished download (.part) in the wheelhouse is
+# considered abandoned and removed
+WHEELHOUSE_PARTIAL_MAX_AGE = 60 * 60
+
+# simple index (PEP 503) used to prefetch the pinned requirements (pip
+# uses the same environment variable)
+PREFETCH_INDEX_URL = os.environ.get(
+    "PIP_INDEX_URL", "https://pypi.python.org/simple/")
+
+# parallel downloads of the prefetch
+PREFETCH_WORKERS = 4
+
+# attempts of every download and seconds to wait after the first failure
+# (doubled after each one)
+PREFETCH_RETRIES = 3
+PREFETCH_BACKOFF = 0.5
+
+# seconds without data before a download is aborted
+PREFETCH_TIMEOUT = 30
+
+# live child processes allowed at the same time
+SUPERVISOR_MAX_PROCS = 64
+
+# finished processes remembered with their exit code and duration
+SUPERVISOR_HISTORY = 100
+
+# seconds to wait the process groups to end on exit before kill them
+SUPERVISOR_SHUTDOWN_TIMEOUT = 5
+
+# seconds between two samples of the resources used by the server
+SAMPLER_INTERVAL = 1.0
+
+# samples kept in memory (one hour with the default interval)
+SAMPLER_SIZE = 3600
 
 ENCODING = "UTF-8"
 
@@ -139,11 +221,23 @@ LOG_FPATH = os.path.join(
 
 DB_FPATH = os.path.join(LAUNCHER_DIR_PATH, "launcher.db")
 
+WHEELHOUSE_PATH = os.path.join(LAUNCHER_DIR_PATH, "wheelhouse")
+
+# compressed copy of the launcher virtualenv taken after it is created
+VENV_SNAPSHOT_PATH = os.path.join(LAUNCHER_DIR_PATH, "oTree.tar.gz")
+
+# the own virtualenvs of the isolated deploys (clones of LAUNCHER_VENV_PATH)
+DEPLOY_VENVS_PATH = os.path.join(LAUNCHER_DIR_PATH, "venvs")
+
 INTERPRETER = "" if IS_WINDOWS else "bash"
 
 VENV_SCRIPT_DIR_PATH = os.path.join(LAUNCHER_VENV_PATH,
                                     "Scripts" if IS_WINDOWS else "bin")
 
+VENV_PYTHON_PATH = os.path.join(
+    VENV_SCRIPT_DIR_PATH, "python.exe" if IS_WINDOWS else "python"
+)
+
 ACTIVATE_PATH = (
     os.path.join(VENV_SCRIPT_DIR_PATH, "activate.bat")
     if IS_WINDOWS else
@@ -157,26 +251,8 @@ ACTIVATE_CMD = (
     "source \"{}\"".format(ACTIVATE_PATH)
 )
 
-
-GIT_CMD = (
-    "git"
-    if GIT_AVAILABLE else
-    "python \"{}\"".format(os.path.join(VENV_SCRIPT_DIR_PATH, "dulwich"))
-)
-
-
-END_CMD = (
-    " >> \"{}\" 2>&1 || goto :error \n"
-    if IS_WINDOWS else
-    " >> \"{}\" 2>&1 ;\n"
-).format(LOG_FPATH)
-
 SCRIPT_EXTENSION = "bat" if IS_WINDOWS else "sh"
 
-SCRIPT_HEADER = ["@echo off"] if IS_WINDOWS else ["set -e;"]
-
-SCRIPT_FOOTER = ["", ":error", "  exit /b %errorlevel%"] if IS_WINDOWS else []
-
 DULWICH_PKG = (
     res.get("packages", "dulwich_windows-0.9.8-cp27-none-any.whl")
     if IS_WINDOWS else
@@ -185,28 +261,50 @@ DULWICH_PKG = (
 
 VIRTUALENV_CREATOR_PATH = res.get("packages", "virtualenv", "virtualenv.py")
 
+# the bulk population (hardlinks or threaded copies) only pays off where
+# virtualenv.py can't symlink the interpreter files
+VIRTUALENV_OPTIONS = (
+    ["--bulk"] if IS_WINDOWS or not hasattr(os, "symlink") else []
+)
+
+# single branch clones when git is not available
+DULWICH_CLONE_PATH = res.get("scripts", "dulwich_clone.py")
+
 
 # =============================================================================
 # TEMPLATES FOS SCRIPTS
 # =============================================================================
 
+# A line starting with '||' runs only if the previous one fails.
+# The wheels are built only once (in the wheelhouse), later installs work
+# offline if all the wheels are there
+
+_UPGRADE_PIP_CMDS = """
+python -m pip install --upgrade --no-index --find-links "$WHEELHOUSE_PATH" pip wheel
+|| python -m pip install --upgrade pip wheel
+"""
+
+_INSTALL_WHEELS_CMDS = """
+python -m pip wheel --no-index --find-links "$WHEELHOUSE_PATH" --wheel-dir "$WHEELHOUSE_PATH" pip wheel -r "$REQUIREMENTS_PATH"
+|| python -m pip wheel --find-links "$WHEELHOUSE_PATH" --wheel-dir "$WHEELHOUSE_PATH" pip wheel -r "$REQUIREMENTS_PATH"
+python -m pip install --upgrade --no-index --find-links "$WHEELHOUSE_PATH" -r "$REQUIREMENTS_PATH"
+"""
+
 CREATE_VENV_CMDS_TEMPLATE = """
-python "$VIRTUALENV_CREATOR_PATH" "$LAUNCHER_VENV_PATH"
+python "$VIRTUALENV_CREATOR_PATH" $VIRTUALENV_OPTIONS "$LAUNCHER_VENV_PATH"
 $ACTIVATE_CMD
-python -m pip install --upgrade pip
+""" + _UPGRADE_PIP_CMDS + """
 python -m pip install "$DULWICH_PKG" --global-option="--pure"
-python -m pip install --upgrade -r "$REQUIREMENTS_PATH"
-"""
+""" + _INSTALL_WHEELS_CMDS
 
 CLONE_CMDS_TEMPLATE = """
 $ACTIVATE_CMD
-$GIT_CMD clone "$OTREE_REPO" "$WRK_PATH"
+$CLONE_CMD "$OTREE_REPO" "$WRK_PATH"
 """
 
 INSTALL_REQUIREMENTS_CMDS_TEMPLATE = """
 $ACTIVATE_CMD
-python -m pip install --upgrade -r "$REQUIREMENTS_PATH"
-"""
+""" + _UPGRADE_PIP_CMDS + _INSTALL_WHEELS_CMDS
 
 RESET_CMDS_TEMPLATE = """
 $ACTIVATE_CMD
@@ -217,7 +315,7 @@ python "$OTREE_SCRIPT_PATH" resetdb --noinput
 RUN_CMDS_TEMPLATE = """
 $ACTIVATE_CMD
 cd "$WRK_PATH"
-python "$OTREE_SCRIPT_PATH" runserver
+python "$OTREE_SCRIPT_PATH" runserver $PORT
 """
 
 if IS_WINDOWS:
@@ -262,13 +360,135 @@ logger.addHandler(logging.StreamHandler())
 logger.setLevel(logging.INFO)
 
 
+# =============================================================================
+# VERSION
+# =============================================================================
+
+_version = []
+
+
+def version():
+    """The project version as tuple of strings (readed only the first time)
+
+    """
+    if not _version:
+        with open(res.get("version.json")) as fp:
+            _version.append(tuple(json.load(fp)["version"]))
+    return _version[0]
+
+
+def str_version():
+    """The project version as string"""
+    return ".".join(version())
+
+
+# =============================================================================
+# CAPABILITIES
+# =============================================================================
+
+def which(binary):
+    """Return the full path of *binary* searching in the PATH or None.
+
+    Only the filesystem is inspected, no subprocess is spawned
+
+    """
+    exts = (
+        os.getenv("PATHEXT", ".EXE").split(os.pathsep)
+        if IS_WINDOWS else [""]
+    )
+    for dpath in os.getenv("PATH", "").split(os.pathsep):
+        for ext in exts:
+            fpath = os.path.join(dpath.strip('"'), str(binary + ext))
+            if os.path.isfile(fpath) and os.access(fpath, os.X_OK):
+                return fpath
+    return None
+
+
+class CapabilityRegistry(object):
+    """Lazy registry of the external tools used by the launcher.
+
+    Every capability is probed the first time is requested and the result
+    is stored in the launcher database keyed by the PATH and the mtime of the
+    probed binary, so a warm start never spawns a subprocess
+
+    """
+
+    def __init__(self):
+        self._probes = {}
+        self._results = {}
+
+    def register(self, name, binary, args):
+        """Register a new capability *name* available if the command
+        *binary* with the arguments *args* exits without errors
+
+        """
+        self._probes[name] = (binary, tuple(args))
+        self._results.pop(name, None)
+
+    def fingerprint(self, name):
+        """The key used to store the result of the probe of *name*"""
+        binary, args = self._probes[name]
+        fpath = which(binary)
+        mtime = os.path.getmtime(fpath) if fpath else None
+        return json.dumps([os.getenv("PATH", ""), fpath, mtime])
+
+    def probe(self, name):
+        """Run the command of the capability *name* without cache"""
+        binary, args = self._probes[name]
+        fpath = which(binary)
+        if fpath is None:
+            return False
+        with open(os.devnull, "w") as devnull:
+            try:
+                code = subprocess.call(
+                    [fpath] + list(args), stdout=devnull, stderr=devnull
+                )
+            except OSError:
+                return False
+        return code == 0
+
+    def get(self, name):
+        """Return True if the capability *name* is available"""
+        if name not in self._results:
+            from . import db
+            key = self.fingerprint(name)
+            available = db.get_capability(name, key)
+            if available is None:
+                logger.info("Probing capability '{}'...".format(name))
+                available = self.probe(name)
+                db.set_capability(name, key, available)
+            self._results[name] = available
+        return self._results[name]
+
+    __getitem__ = get
+
+    def clear(self):
+        """Forget all the results probed in this process"""
+        self._results.clear()
+
+
+CAPABILITIES = CapabilityRegistry()
+
+CAPABILITIES.register("git", "git", ["--version"])
+
+
+def git_available():
+    return CAPABILITIES.get("git")
+
+
 # =============================================================================
 # DIRECTORIES & FILES
 # =============================================================================
 
-for dpath in [LAUNCHER_DIR_PATH, LAUNCHER_TEMP_DIR_PATH, LOG_DIR_PATH]:
-    if not os.path.isdir(dpath):
-        os.makedirs(dpath)
+def ensure_dirs():
+    """Create the directories used by the launcher if not exists"""
+    for dpath in [LAUNCHER_DIR_PATH, LAUNCHER_TEMP_DIR_PATH, LOG_DIR_PATH,
+                  WHEELHOUSE_PATH]:
+        try:
+            os.makedirs(dpath)
+        except OSError:  # already exists (maybe created by other thread)
+            if not os.path.isdir(dpath):
+                raise
 
 
 # =============================================================================
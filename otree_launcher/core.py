@@ -33,13 +33,32 @@ import glob
 import sys
 import datetime
 import zipfile
+import threading
+import time
+import shlex
+import codecs
+import errno
+import collections
+import socket
+import re
+import logging
+import mmap
+import array
+import hashlib
+import shutil
+import functools
+import tarfile
+import contextlib
+import io
+import Queue
+import HTMLParser
 
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 
-from . import cons, ctx, db
+from . import cons, ctx, db, monitor
 
 
 # =============================================================================
@@ -65,61 +84,449 @@ class InstallError(Exception):
         )
 
 
+class ChecksumError(IOError):
+    """The content downloaded not match the checksum of the index"""
+
+
+# =============================================================================
+# TASKS
+# =============================================================================
+
+class TaskRunner(object):
+    """Run functions in parallel threads and keep their results and
+    timings.
+
+    The *critical* tasks are the ones that must end before the program can
+    continue (see ``critical_done``)
+
+    """
+
+    def __init__(self):
+        self.tasks = {}
+        self.timings = {}
+
+    def add(self, name, func, *args, **kwargs):
+        """Start ``func(*args, **kwargs)`` in a new thread. The keyword
+        argument *critical* (default True) is not passed to the function
+
+        """
+        critical = kwargs.pop("critical", True)
+        task = {"critical": critical, "event": threading.Event(),
+                "result": None, "error": None}
+
+        def run():
+            start = time.time()
+            try:
+                task["result"] = func(*args, **kwargs)
+            except Exception as err:
+                task["error"] = err
+            finally:
+                self.timings[name] = time.time() - start
+                logger.info("Task '{}' done in {:.3f} sec".format(
+                    name, self.timings[name]))
+                task["event"].set()
+
+        self.tasks[name] = task
+        thread = threading.Thread(target=run, name="task-{}".format(name))
+        thread.daemon = True
+        thread.start()
+
+    def critical_done(self):
+        """Return True if all the critical tasks are finished"""
+        return all(
+            task["event"].is_set()
+            for task in self.tasks.values() if task["critical"]
+        )
+
+    def result(self, name, timeout=None):
+        """Wait for the task *name* and return its result or raise the
+        exception raised inside the task
+
+        """
+        task = self.tasks[name]
+        task["event"].wait(timeout)
+        if task["error"] is not None:
+            raise task["error"]
+        return task["result"]
+
+
+# =============================================================================
+# SUPERVISOR
+# =============================================================================
+
+class ProcessSupervisor(object):
+    """Keep track of every child process started by the launcher.
+
+    The live processes are stored in a registry of at most *limit* entries.
+    The finished ones are reaped (on every spawn or calling ``reap``) and
+    moved to a *history* of the last *history_size* with their exit code
+    and duration. ``shutdown`` terminates all the process groups still
+    alive, waiting *timeout* seconds before killing them; is registered
+    only once with atexit
+
+    """
+
+    def __init__(self, limit=cons.SUPERVISOR_MAX_PROCS,
+                 history_size=cons.SUPERVISOR_HISTORY,
+                 timeout=cons.SUPERVISOR_SHUTDOWN_TIMEOUT):
+        self.limit = limit
+        self.timeout = timeout
+        self.live = collections.OrderedDict()
+        self.history = collections.deque(maxlen=history_size)
+        self._lock = threading.Lock()
+
+    def spawn(self, argv, factory, *args, **kwargs):
+        """Create a process with ``factory(*args, **kwargs)`` and register
+        it with *argv* as description.
+
+        Raises OSError (EAGAIN) if there are *limit* live processes
+
+        """
+        with self._lock:
+            self._reap()
+            if len(self.live) >= self.limit:
+                raise OSError(errno.EAGAIN, "Too many running processes ({})"
+                              .format(len(self.live)))
+            proc = factory(*args, **kwargs)
+            self.live[proc.pid] = {
+                "proc": proc, "pid": proc.pid, "argv": argv,
+                "start": time.time()
+            }
+        return proc
+
+    def _reap(self):
+        now = time.time()
+        for pid, record in list(self.live.items()):
+            returncode = record["proc"].poll()
+            if returncode is None:
+                continue
+            del self.live[pid]
+            record = dict(record, returncode=returncode,
+                          duration=now - record["start"])
+            del record["proc"]
+            self.history.append(record)
+
+    def reap(self):
+        """Move the finished processes to the history"""
+        with self._lock:
+            self._reap()
+
+    def running(self):
+        """The Popen objects of the processes still alive"""
+        with self._lock:
+            self._reap()
+            return [record["proc"] for record in self.live.values()]
+
+    def records(self):
+        """The finished processes (oldest first) without the Popen objects
+        """
+        with self._lock:
+            self._reap()
+            return list(self.history)
+
+    def shutdown(self, timeout=None):
+        """Terminate the process group of every live process, wait for all
+        of them *timeout* seconds in total and kill the ones left.
+
+        Returns the pids of the killed processes
+
+        """
+        timeout = self.timeout if timeout is None else timeout
+        procs = self.running()
+        for proc in procs:
+            try:
+                signal_group(proc.pid)
+            except OSError as err:
+                logger.warning("Can't stop {}: {}".format(proc.pid, err))
+
+        end = time.time() + timeout
+        alive = procs
+        while alive and time.time() < end:
+            time.sleep(0.05)
+            alive = [proc for proc in alive if proc.poll() is None]
+
+        for proc in alive:
+            try:
+                signal_group(proc.pid, force=True)
+            except OSError as err:
+                logger.warning("Can't kill {}: {}".format(proc.pid, err))
+        self.reap()
+        return [proc.pid for proc in alive]
+
+
+SUPERVISOR = ProcessSupervisor()
+
+atexit.register(SUPERVISOR.shutdown)
+
+
 # =============================================================================
 # HELPER FUNCTIONS
 # =============================================================================
 
-def check_connectivity(timeout=1):
-    """Check if all servers needed for use oTree-launcher are online
+class NoRedirectHandler(urllib2.HTTPRedirectHandler):
+    """Do not follow redirections (urllib2 follows a HEAD with a GET); the
+    3xx answer raises an HTTPError instead
 
     """
-    errors = []
-    for server in cons.SERVERS:
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+def probe_servers(servers, deadline):
+    """Send a HEAD request to all the *servers* at the same time and wait
+    for them at most *deadline* seconds in total. A redirection is not
+    followed: the server answers, so is reachable.
+
+    Returns a list with a message for every unreachable server
+
+    """
+    reachable = set()
+    opener = urllib2.build_opener(NoRedirectHandler)
+
+    def probe(server):
+        request = urllib2.Request(server)
+        request.get_method = lambda: "HEAD"
         try:
-            urllib2.urlopen(server, timeout=timeout)
-        except urllib2.URLError:
-            host = urlparse.urlsplit(server).netloc
-            errors.append("'{}' is unreachable".format(host))
+            with contextlib.closing(opener.open(request, timeout=deadline)):
+                pass
+        except urllib2.HTTPError:
+            pass  # the server answers (maybe redirecting), so is online
+        except Exception:
+            return
+        reachable.add(server)
+
+    threads = []
+    for server in servers:
+        thread = threading.Thread(target=probe, args=(server,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    end = time.time() + deadline
+    for thread in threads:
+        thread.join(max(0, end - time.time()))
+
+    return [
+        "'{}' is unreachable".format(urlparse.urlsplit(server).netloc)
+        for server in servers if server not in reachable
+    ]
+
+
+def check_connectivity(servers=None, deadline=None, use_cache=True):
+    """Check if all servers needed for use oTree-launcher are online
+
+    The result is stored in the launcher database and reused for
+    CONNECTIVITY_TTL seconds (or CONNECTIVITY_FAIL_TTL if fails)
+
+    """
+    servers = cons.SERVERS if servers is None else servers
+    deadline = cons.CONNECTIVITY_DEADLINE if deadline is None else deadline
+
+    cache_key = "connectivity:{}".format(json.dumps(sorted(servers)))
+    errors = db.cache_get(cache_key) if use_cache else None
+    if errors is None:
+        errors = probe_servers(servers, deadline)
+        ttl = cons.CONNECTIVITY_FAIL_TTL if errors else cons.CONNECTIVITY_TTL
+        db.cache_set(cache_key, errors, ttl)
     if errors:
         errors_joined = "\n  ".join(errors)
         msg = "Check your internet connection\n  {}".format(errors_joined)
         raise IOError(msg)
 
 
-def kill_proc(proc):
+def signal_group(pid, force=False):
+    """Send SIGTERM (or SIGKILL if *force*) to the process group leaded by
+    *pid*. On Windows the whole tree is always killed with TASKKILL
+
+    """
     if cons.IS_WINDOWS:
-        proc = call(["TASKKILL", "/F", "/PID", str(proc.pid), "/T"])
-        proc.communicate()
+        subprocess.call(
+            ["TASKKILL", "/F", "/PID", str(pid), "/T"],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
     else:
         import signal
-        os.killpg(proc.pid, signal.SIGTERM)
+        try:
+            os.killpg(pid, signal.SIGKILL if force else signal.SIGTERM)
+        except OSError as err:
+            if err.errno != errno.ESRCH:  # already gone
+                raise
+
+
+def pid_alive(pid):
+    """True if exists a process with the given *pid* (maybe of other user)
+    """
+    if cons.IS_WINDOWS:
+        out = subprocess.Popen(
+            ["TASKLIST", "/FI", "PID eq {}".format(pid), "/NH"],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        ).communicate()[0]
+        return str(pid) in out.decode(cons.ENCODING, "replace").split()
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
 
 
-def clean_proc(proc):
-    """Clean process if is still runing on exit"""
-    if proc.poll() is None:
-        kill_proc(proc)
+def process_cmdline(pid):
+    """The command line of *pid* as an unicode string, or None if can't
+    be read
+
+    """
+    try:
+        if monitor.available():
+            out = b" ".join(monitor.cmdline(pid))
+        elif cons.IS_WINDOWS:
+            out = subprocess.Popen(
+                ["WMIC", "PROCESS", "WHERE", "ProcessId={}".format(pid),
+                 "GET", "CommandLine", "/VALUE"],
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+            ).communicate()[0]
+        else:
+            out = subprocess.Popen(
+                ["ps", "-o", "command=", "-p", str(pid)],
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+            ).communicate()[0]
+    except (IOError, OSError):
+        return None
+    return out.decode(cons.ENCODING, "replace")
+
+
+def is_server(pid, port=None, started=None):
+    """True if *pid* is alive and is still the oTree server listening in
+    *port* that was started at *started* (a stored pid can belong to any
+    other process after a crash or a reboot). Where /proc is available the
+    start time of the process is compared too
+
+    """
+    if not pid or not pid_alive(pid):
+        return False
+    args = (process_cmdline(pid) or "").split()
+    if "runserver" not in args or (port and str(port) not in args):
+        return False
+    if started and monitor.available():
+        try:
+            delay = monitor.start_time(pid) - started
+        except (IOError, OSError, ValueError, IndexError):
+            return False
+        # the boot time has 1 s precision and the server can be spawned
+        # up to SERVER_SPAWN_TIMEOUT seconds after the Server is created
+        if not -1 <= delay <= cons.SERVER_SPAWN_TIMEOUT + 1:
+            return False
+    return True
+
+
+def group_alive(pgid):
+    """True while some process of the group *pgid* exists (and is not a
+    zombie, when /proc is available)
+
+    """
+    if cons.IS_WINDOWS:
+        return pid_alive(pgid)
+    if monitor.available():
+        return bool(monitor.group_pids(pgid))
+    try:
+        os.killpg(pgid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+
+def wait_for(condition, timeout, interval=0.05):
+    """Call *condition* until returns a true value or *timeout* seconds
+    pass. Returns True if the condition was met, False on timeout
+
+    """
+    end = time.time() + timeout
+    while not condition():
+        if time.time() >= end:
+            return False
+        time.sleep(interval)
+    return True
+
+
+def stop_group(pgid, leader=None, grace=None, kill_grace=None, port=None):
+    """Stop every process of the group *pgid* escalating: SIGTERM, wait
+    *grace* seconds, SIGKILL and wait *kill_grace* seconds more. If *port*
+    is given, wait also (at most *kill_grace*) until is released.
+
+    *leader* is the Popen of the group leader when nobody else waits for it
+    (so is reaped here). Returns a dict with the *duration*, if the group
+    was *killed*, if is *stopped* and if the port was released
+
+    """
+    grace = cons.STOP_GRACE if grace is None else grace
+    kill_grace = cons.STOP_KILL_GRACE if kill_grace is None else kill_grace
+    start = time.time()
+
+    def ended():
+        if leader is not None:
+            leader.poll()
+        return not group_alive(pgid)
+
+    report = {"killed": False, "port_released": None}
+    signal_group(pgid)
+    if not wait_for(ended, grace):
+        logger.warning(
+            "Group {} still alive after {} sec, killing it".format(
+                pgid, grace))
+        signal_group(pgid, force=True)
+        report["killed"] = True
+        wait_for(ended, kill_grace)
+    report["stopped"] = ended()
+    if port is not None:
+        report["port_released"] = wait_for(
+            lambda: not port_in_use(port), kill_grace)
+    report["duration"] = time.time() - start
+    return report
+
+
+def stop_proc(proc, grace=None, kill_grace=None, port=None):
+    """Stop *proc* (a Popen or a StepRunner) and every process of its group
+    (see stop_group). Blocks until ends, so call it out of the gui thread
+
+    """
+    if isinstance(proc, StepRunner):
+        proc.cancel()
+        leader = None  # reaped by the runner
+    else:
+        leader = proc
+    if not proc.pid:  # nothing started
+        released = None if port is None else not port_in_use(port)
+        return {"killed": False, "stopped": True, "duration": 0.,
+                "port_released": released}
+    return stop_group(proc.pid, leader, grace, kill_grace, port)
+
+
+def kill_proc(proc):
+    if isinstance(proc, StepRunner):
+        proc = proc.cancel()
+        if proc is None:
+            return
+    signal_group(proc.pid)
 
 
 def call(command, *args, **kwargs):
-    """Call an external command"""
+    """Call an external command (tracked by SUPERVISOR)"""
     cleaned_cmd = [cmd.strip() for cmd in command if cmd.strip()]
     if cons.IS_WINDOWS:
-        win_cmd = "{} < Nul".format(" ".join(cleaned_cmd))
-        proc = subprocess.Popen(win_cmd, shell=True, *args, **kwargs)
-    else:
-        proc = subprocess.Popen(
-            cleaned_cmd, preexec_fn=os.setsid, *args, **kwargs
+        win_cmd = "{} < Nul".format(subprocess.list2cmdline(cleaned_cmd))
+        return SUPERVISOR.spawn(
+            cleaned_cmd, subprocess.Popen, win_cmd, shell=True,
+            *args, **kwargs
         )
-    atexit.register(clean_proc, proc)
-    return proc
+    return SUPERVISOR.spawn(
+        cleaned_cmd, subprocess.Popen, cleaned_cmd, preexec_fn=os.setsid,
+        *args, **kwargs
+    )
 
 
-def render(template, wrkpath, decorate=True, **kwargs):
-    """Render template acoring the working path
+def render_context(wrkpath, **kwargs):
+    """Variables available to the templates for the given working path
 
     """
-    # vars
     context = {
         k: v for k, v in vars(cons).items()
         if not k.startswith("_") and k.isupper()
@@ -128,31 +535,1356 @@ def render(template, wrkpath, decorate=True, **kwargs):
         "WRK_PATH": wrkpath.replace("/", os.path.sep),
         "REQUIREMENTS_PATH": os.path.join(wrkpath, cons.REQUIREMENTS_FNAME),
         "OTREE_SCRIPT_PATH": os.path.join(wrkpath, cons.OTREE_SCRIPT_FNAME),
+        "VENV_PATH": cons.LAUNCHER_VENV_PATH,
     })
     context.update(kwargs)
+    if context["VENV_PATH"] != cons.LAUNCHER_VENV_PATH:
+        activate = venv_paths(context["VENV_PATH"])[2]
+        context["ACTIVATE_PATH"] = activate
+        context["ACTIVATE_CMD"] = (
+            "call \"{}\"" if cons.IS_WINDOWS else "source \"{}\"").format(
+                activate)
+    return context
+
 
+def render(template, wrkpath, **kwargs):
+    """Render template acoring the working path
+
+    """
+    context = render_context(wrkpath, **kwargs)
     src = string.Template(template.strip()).substitute(**context)
+    script = "\n".join([l.strip() for l in src.splitlines()])
+    return script.strip() + "\n"
+
+
+# =============================================================================
+# OUTPUT
+# =============================================================================
+
+class OutputBus(object):
+    """Fan out every line written by the external processes to all the
+    subscribers.
+
+    The subscribers are called from the thread that reads the process
+    output with the *source* (the name of the running steps), the
+    *timestamp* and the *line* without the line break; so they must be
+    thread safe
+
+    """
+
+    def __init__(self):
+        self.subscribers = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, subscriber):
+        with self._lock:
+            self.subscribers = self.subscribers + [subscriber]
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self.subscribers = [
+                sub for sub in self.subscribers if sub != subscriber
+            ]
+
+    def publish(self, source, timestamp, line):
+        for subscriber in self.subscribers:
+            try:
+                subscriber(source, timestamp, line)
+            except Exception as err:
+                logger.error(
+                    "Output subscriber {!r} fails: {}".format(subscriber, err)
+                )
+
+    def feed(self, source, fp):
+        """Read *fp* line by line until the end and publish every line"""
+        for raw in iter(fp.readline, b""):
+            line = raw.decode(cons.ENCODING, "replace").rstrip("\r\n")
+            self.publish(source, time.time(), line)
+
+
+def format_stamp(timestamp):
+    """The 'HH:MM:SS.mmm' prefix of every line of the daily log"""
+    return "{}.{:03d}".format(
+        time.strftime("%H:%M:%S", time.localtime(timestamp)),
+        int(timestamp * 1000) % 1000
+    )
+
+
+class LogFileWriter(object):
+    """Output subscriber that appends the timestamped lines to a log file
+    (opened the first time is needed)
+
+    """
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self.fp = None
+        self._lock = threading.Lock()
+
+    def __call__(self, source, timestamp, line):
+        stamp = format_stamp(timestamp)
+        with self._lock:
+            if self.fp is None:
+                cons.ensure_dirs()
+                self.fp = codecs.open(self.fpath, "a", encoding=cons.ENCODING)
+            self.fp.write("[{}] {}\n".format(stamp, line))
+            self.fp.flush()
+
+
+class LogWriterHandler(logging.Handler):
+    """Logging handler that writes the launcher messages in the daily log
+    next to the output of the processes.
+
+    The records with an ``output`` attribute are lines of a process already
+    written by the OUTPUT bus and are skipped
+
+    """
+
+    def __init__(self, writer):
+        super(LogWriterHandler, self).__init__()
+        self.writer = writer
+
+    def emit(self, record):
+        if getattr(record, "output", False):
+            return
+        try:
+            self.writer("launcher", record.created, self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+class LogIndex(object):
+    """Offsets of the lines of a log written by LogFileWriter.
+
+    The file is mapped in memory and every refresh only scans the bytes
+    appended since the previous one, so any page of a huge log can be read
+    without loading the whole file. The offsets are kept in an array of
+    machine integers (8 bytes per line)
+
+    """
+
+    STAMP_SIZE = len("[HH:MM:SS.mmm]")
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self.offsets = array.array(str("L"))
+        self.scanned = 0
+        self.mm = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def refresh(self):
+        """Index the lines appended to the file since the last call"""
+        try:
+            size = os.path.getsize(self.fpath)
+        except OSError:
+            return
+        if size < self.scanned:  # truncated or replaced
+            self.close()
+            self.offsets = array.array(str("L"))
+            self.scanned = 0
+        if not size or (self.mm is not None and size == len(self.mm)):
+            return
+        self.close()
+        with open(self.fpath, "rb") as fp:
+            self.mm = mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ)
+        start, find = self.scanned, self.mm.find
+        end = find(b"\n", start)
+        while end != -1:
+            self.offsets.append(start)
+            start = end + 1
+            end = find(b"\n", start)
+        self.scanned = start
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def _bounds(self, idx):
+        start = self.offsets[idx]
+        if idx + 1 < len(self.offsets):
+            return start, self.offsets[idx + 1] - 1
+        return start, self.scanned - 1
+
+    def line(self, idx):
+        """The text of the line number *idx* (without the end of line)"""
+        start, end = self._bounds(idx)
+        return self.mm[start:end].decode(cons.ENCODING, "replace")
+
+    def stamp(self, idx):
+        """The 'HH:MM:SS.mmm' of the line *idx* or "" if has no stamp"""
+        start, end = self._bounds(idx)
+        head = self.mm[start:min(end, start + self.STAMP_SIZE)]
+        if len(head) == self.STAMP_SIZE and head.startswith(b"["):
+            return head[1:-1].decode("ascii", "replace")
+        return ""
+
+    def record_stamp(self, idx):
+        """The stamp of the line *idx* or of the record it belongs to (only
+        the first line of a multiline record has stamp)
+
+        """
+        stamp = self.stamp(idx)
+        while not stamp and idx > 0:
+            idx -= 1
+            stamp = self.stamp(idx)
+        return stamp
+
+    def bisect(self, stamp):
+        """Index of the first line logged at *stamp* ('HH:MM:SS.mmm', see
+        ``format_stamp``) or later
+
+        """
+        low, high = 0, len(self.offsets)
+        while low < high:
+            middle = (low + high) // 2
+            if self.record_stamp(middle) < stamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def page(self, end, size):
+        """Return the index of the first line and the list of the *size*
+        lines (at most) before the line *end*
+
+        """
+        end = min(end, len(self.offsets))
+        start = max(0, end - size)
+        return start, [self.line(idx) for idx in range(start, end)]
+
+
+OUTPUT = OutputBus()
+
+LOG_WRITER = LogFileWriter(cons.LOG_FPATH)
+
+OUTPUT.subscribe(LOG_WRITER)
+
+
+# =============================================================================
+# STEPS
+# =============================================================================
+
+def plan(template, wrkpath, **kwargs):
+    """Convert a *_CMDS_TEMPLATE into a list of steps to run without shell
+
+    Every step is a dict with the *argv* of the command, the working
+    directory *cwd* and the virtualenv where must run (*venv*, the
+    ``VENV_PATH`` given or the launcher one; None outside). The
+    ``$ACTIVATE_CMD`` line marks that the next steps run in the virtualenv
+    and the ``cd <path>`` lines change the working directory of the next
+    steps. A line starting with ``||`` is an *alternative* step: runs only
+    if the previous one fails (and then that failure is not fatal). A
+    ``$NAME`` token whose value is a list is replaced by all its items (a
+    whole command built by the caller).
+
+    """
+    context = render_context(wrkpath, **kwargs)
+    steps, cwd, venv = [], None, None
+    for line in template.strip().splitlines():
+        tokens = [
+            token.decode("utf8")
+            for token in shlex.split(line.strip().encode("utf8"))
+        ]
+        if not tokens:
+            continue
+        if tokens == ["$ACTIVATE_CMD"]:
+            venv = context["VENV_PATH"]
+            continue
+        alternative = tokens[0] == "||"
+        if alternative:
+            tokens = tokens[1:]
+        argv = []
+        for token in tokens:
+            value = context.get(token[1:]) if token[:1] == "$" else None
+            if isinstance(value, list):
+                argv.extend(value)
+            else:
+                argv.append(string.Template(token).substitute(**context))
+        if argv[0] == "cd":
+            cwd = argv[1]
+            continue
+        steps.append({"argv": argv, "cwd": cwd, "venv": venv,
+                      "alternative": alternative})
+    return steps
+
+
+def func_step(label, func):
+    """A step that calls *func* in the runner thread instead of running a
+    command; fails if *func* raises
+
+    """
+    return {"argv": [label], "cwd": None, "venv": None,
+            "alternative": False, "func": func}
+
+
+def fs_encode(value):
+    """Encode unicode values as needed by the process environment"""
+    if isinstance(value, unicode) and not cons.IS_WINDOWS:
+        return value.encode(sys.getfilesystemencoding() or cons.ENCODING)
+    return value
+
+
+def venv_environ(venv=None):
+    """The environment variables that the activate script of *venv* (the
+    launcher virtualenv by default) sets
+
+    """
+    venv = venv or cons.LAUNCHER_VENV_PATH
+    env = dict(os.environ)
+    env.pop(str("PYTHONHOME"), None)
+    env[str("VIRTUAL_ENV")] = fs_encode(venv)
+    env[str("PATH")] = os.pathsep.join([
+        fs_encode(venv_paths(venv)[0]), env.get(str("PATH"), str(""))
+    ])
+    return env
+
+
+def venv_argv(argv, venv):
+    """The *argv* to run in the virtualenv *venv*: ``python`` is the
+    interpreter of the virtualenv (not the first one in PATH, that is the
+    system one when the virtualenv is missing). Returns None if *venv* has
+    no interpreter
+
+    """
+    if venv is None or argv[:1] != ["python"]:
+        return argv
+    python = venv_paths(venv)[1]
+    if not os.path.isfile(python):
+        return None
+    return [python] + argv[1:]
+
+
+class StepRunner(object):
+    """Run the steps created by ``plan`` one after another in a background
+    thread, stopping on the first failure not followed by an alternative
+    step, and record the wall time and exit status of every command in
+    *records*. Before the first step *prepare* is called with the runner
+    (a failure there is only logged) and if all gone well *on_success*.
+
+    The output of the commands is published line by line in OUTPUT with
+    *name* as source.
+
+    Looks like the Popen objects returned by ``call`` (``poll``, ``wait``,
+    ``pid`` and ``returncode``) so can be used in the same places. The event
+    *spawned* is set when the first command is started (or the runner ends)
+
+    """
+
+    def __init__(self, steps, name="steps", on_success=None, prepare=None):
+        self.steps = steps
+        self.name = name
+        self.on_success = on_success
+        self.prepare = prepare
+        self.records = []
+        self.returncode = None
+        self.proc = None
+        self.cancelled = False
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self.spawned = threading.Event()
+        thread = threading.Thread(target=self._run, name=name)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def pid(self):
+        proc = self.proc
+        return proc.pid if proc else None
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        while not self._done.wait(1):
+            pass
+        return self.returncode
+
+    def cancel(self):
+        """Do not start more steps and return the running process (if any)
+
+        """
+        with self._lock:
+            self.cancelled = True
+            proc = self.proc
+        return proc if proc and proc.poll() is None else None
+
+    def _run(self):
+        returncode = 0
+        envs = {None: None}
+        try:
+            if self.prepare is not None and self.steps:
+                try:
+                    self.prepare(self)
+                except Exception as err:
+                    logger.warning("Can't prepare '{}': {}".format(
+                        self.name, err))
+            for idx, step in enumerate(self.steps):
+                if step.get("alternative") and not returncode:
+                    continue
+                returncode = self._run_step(step, envs)
+                following = self.steps[idx + 1:idx + 2]
+                if returncode and not (
+                        following and following[0].get("alternative")):
+                    break
+            if not returncode and self.on_success is not None:
+                self.on_success(self)
+        finally:
+            self.returncode = returncode
+            self.spawned.set()
+            self._done.set()
+
+    def _run_step(self, step, envs):
+        cmd = " ".join(step["argv"])
+        start = time.time()
+        if step["venv"] not in envs:
+            envs[step["venv"]] = venv_environ(step["venv"])
+        argv = venv_argv(step["argv"], step["venv"])
+        with self._lock:
+            if self.cancelled:
+                return -1
+            self.proc = None
+            if "func" not in step and argv is None:
+                logger.error(
+                    "Can't run '{}': the virtualenv '{}' is missing or "
+                    "broken".format(cmd, step["venv"]))
+            elif "func" not in step:
+                try:
+                    self.proc = call(
+                        argv, cwd=step["cwd"],
+                        env=envs[step["venv"]],
+                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+                    )
+                except OSError as err:
+                    logger.error("Can't run '{}': {}".format(cmd, err))
+            self.spawned.set()
+        if "func" in step:
+            try:
+                step["func"]()
+                returncode = 0
+            except Exception as err:
+                logger.error("'{}' failed: {}".format(cmd, err))
+                returncode = 1
+        elif self.proc:
+            OUTPUT.feed(self.name, self.proc.stdout)
+            self.proc.stdout.close()
+            returncode = self.proc.wait()
+            SUPERVISOR.reap()
+        else:
+            returncode = 127
+        duration = time.time() - start
+        self.records.append({
+            "argv": step["argv"], "returncode": returncode,
+            "duration": duration
+        })
+        logger.info("'{}' exit with {} in {:.3f} sec".format(
+            cmd, returncode, duration))
+        return returncode
+
+
+def run_steps(name, template, wrkpath, **kwargs):
+    """Plan the *template* and start running it (see StepRunner)"""
+    return StepRunner(plan(template, wrkpath, **kwargs), name)
+
+
+# =============================================================================
+# STEP MEMOS
+# =============================================================================
+
+def file_digest(fpath):
+    """sha1 of the content of *fpath* or None if not exists"""
+    digest = hashlib.sha1()
+    try:
+        with open(fpath, "rb") as fp:
+            for chunk in iter(lambda: fp.read(64 * 1024), b""):
+                digest.update(chunk)
+    except IOError:
+        return None
+    return digest.hexdigest()
+
+
+def repo_head(wrkpath):
+    """The commit checked out in the git repository *wrkpath* (read
+    from .git without running git) or None
+
+    """
+    gitpath = os.path.join(wrkpath, ".git")
+    try:
+        with open(os.path.join(gitpath, "HEAD"), "rb") as fp:
+            head = fp.read().decode("ascii").strip()
+        if not head.startswith("ref:"):
+            return head
+        ref = head[len("ref:"):].strip()
+        refpath = os.path.join(gitpath, *ref.split("/"))
+        if os.path.isfile(refpath):
+            with open(refpath, "rb") as fp:
+                return fp.read().decode("ascii").strip()
+        with open(os.path.join(gitpath, "packed-refs"), "rb") as fp:
+            for line in fp:
+                parts = line.decode("ascii").split()
+                if len(parts) == 2 and parts[1] == ref:
+                    return parts[0]
+    except (IOError, UnicodeDecodeError):
+        pass
+    return None
+
+
+def interpreter_id(fpath):
+    """Identify the interpreter *fpath* by path, size and modification
+    time (a recreated virtualenv has a new one)
+
+    """
+    try:
+        stat = os.stat(fpath)
+    except OSError:
+        return None
+    return [fpath, stat.st_size, int(stat.st_mtime)]
+
+
+def packages_digest(venv):
+    """sha1 of the names of the distributions installed in *venv* (the
+    ``*.dist-info`` and ``*.egg-info`` entries, that have the version) or
+    None if there is no site-packages
+
+    """
+    found = False
+    names = []
+    for pattern in (("lib", "python*", "site-packages"),
+                    ("Lib", "site-packages")):
+        for sitepath in glob.glob(os.path.join(venv, *pattern)):
+            found = True
+            names.extend(
+                fname for fname in os.listdir(sitepath)
+                if fname.endswith((".dist-info", ".egg-info")))
+    if not found:
+        return None
+    data = "\n".join(sorted(set(names))).encode("utf8")
+    return hashlib.sha1(data).hexdigest()
+
+
+def fingerprint(inputs):
+    """sha1 of the json serializable dict *inputs*"""
+    data = json.dumps(inputs, sort_keys=True).encode("utf8")
+    return hashlib.sha1(data).hexdigest()
+
+
+def requirements_inputs(wrkpath, venv=None):
+    """The inputs that decide if the requirements of *wrkpath* must be
+    installed again in *venv* (the virtualenv of the deploy by default).
+
+    The packages installed are an input too: the deploys that are not
+    isolated share the launcher virtualenv, so an install of other deploy
+    changes what this one runs with
+
+    """
+    venv = venv or deploy_venv(wrkpath)
+    return {
+        "requirements": file_digest(
+            os.path.join(wrkpath, cons.REQUIREMENTS_FNAME)),
+        "interpreter": interpreter_id(venv_paths(venv)[1]),
+        "packages": packages_digest(venv),
+        "head": repo_head(wrkpath),
+        "version": cons.str_version()
+    }
+
+
+def is_memoized(name, wrkpath, inputs):
+    """True if the last success of the step *name* in *wrkpath* was with
+    the same *inputs*
+
+    """
+    return db.get_memo(name, wrkpath) == fingerprint(inputs)
+
+
+def run_memoized(name, steps, wrkpath, inputs, force=False, prepare=None,
+                 current=None):
+    """Start a StepRunner with the *steps* (see ``plan``) but nothing is run
+    if the last success of the step *name* in *wrkpath* was with the same
+    inputs (unless *force*).
+
+    *inputs* is a function that returns the inputs; is called again when
+    the steps succeed and only then the fingerprint is stored (so the
+    inputs created by the steps, like a new interpreter, are recorded).
+    *current* are the inputs now if the caller already computed them
+
+    """
+    if current is None and not force:
+        current = inputs()
+    if not force and is_memoized(name, wrkpath, current):
+        logger.info("'{}' is up to date in '{}', skipped".format(
+            name, wrkpath))
+        return StepRunner([], name)
+    db.clear_memo(name, wrkpath)
+    return StepRunner(
+        steps, name, prepare=prepare, on_success=lambda runner: db.set_memo(
+            name, wrkpath, fingerprint(inputs()))
+    )
+
+
+# =============================================================================
+# VIRTUALENVS
+# =============================================================================
+
+# : Files outside the scripts directory that a virtualenv can rewrite in
+# : place (so they are copied and not shared by the clones)
+VENV_MUTABLE_NAMES = ("orig-prefix.txt", "pyvenv.cfg")
+
+VENV_MUTABLE_SUFFIXES = (".pth", ".egg-link")
+
+
+def venv_paths(venv):
+    """The scripts directory, the python interpreter and the activate script
+    of the virtualenv *venv*
+
+    """
+    scripts = os.path.join(venv, os.path.basename(cons.VENV_SCRIPT_DIR_PATH))
+    return (
+        scripts,
+        os.path.join(scripts, os.path.basename(cons.VENV_PYTHON_PATH)),
+        os.path.join(scripts, os.path.basename(cons.ACTIVATE_PATH))
+    )
+
+
+def isolated_venv_path(wrkpath):
+    """Where the own virtualenv of the deploy *wrkpath* lives"""
+    key = hashlib.sha1(os.path.abspath(wrkpath).encode("utf8")).hexdigest()
+    return os.path.join(cons.DEPLOY_VENVS_PATH, key[:16])
 
-    if decorate:
-        script = "".join(
-            ["\n".join(cons.SCRIPT_HEADER), "\n"] +
-            ["{}{}".format(l.strip(), cons.END_CMD)
-             for l in src.splitlines()] +
-            ["\n".join(cons.SCRIPT_FOOTER), "\n"]
+
+def deploy_venv(wrkpath):
+    """The virtualenv used by the deploy *wrkpath*: its own one if was
+    isolated or the launcher one
+
+    """
+    venv = isolated_venv_path(wrkpath) if wrkpath else None
+    return venv if venv and os.path.isdir(venv) else cons.LAUNCHER_VENV_PATH
+
+
+def path_bytes(path):
+    return path.encode(sys.getfilesystemencoding() or cons.ENCODING) \
+        if isinstance(path, unicode) else path
+
+
+def is_text(fpath):
+    with open(fpath, "rb") as fp:
+        return b"\0" not in fp.read(1024)
+
+
+def clone_venv(src, dest):
+    """Clone the virtualenv *src* into *dest* (that must not exist).
+
+    The immutable files (the interpreter, the stdlib and the installed
+    packages) are hardlinked, so a clone costs almost no time nor space;
+    the scripts and the files that can be rewritten in place are copied
+    with every occurrence of *src* replaced by *dest* (activate scripts and
+    shebangs). Symbolic links are recreated pointing inside the clone.
+    Where hardlinks are not possible (other filesystem, Windows) the files
+    are copied.
+
+    The clone is built aside and renamed when is complete. Returns a report
+    with the files *linked*, *copied*, *fixed* and the *duration*
+
+    """
+    start = time.time()
+    report = {"linked": 0, "copied": 0, "fixed": 0, "symlinks": 0}
+    scripts = venv_paths(src)[0]
+    old, new = path_bytes(src), path_bytes(dest)
+    link = getattr(os, "link", None)
+    building = "{}.{}-{}.partial".format(
+        dest, os.getpid(), threading.current_thread().ident)
+
+    def relink(spath, dpath):
+        target = os.readlink(spath)
+        if target == src or target.startswith(src + os.sep):
+            target = dest + target[len(src):]
+        os.symlink(target, dpath)
+        report["symlinks"] += 1
+
+    try:
+        for dirpath, dirnames, filenames in os.walk(src):
+            target_dir = os.path.join(building, os.path.relpath(dirpath, src))
+            os.makedirs(target_dir)
+            for name in list(dirnames):
+                if os.path.islink(os.path.join(dirpath, name)):
+                    relink(os.path.join(dirpath, name),
+                           os.path.join(target_dir, name))
+            for name in filenames:
+                spath = os.path.join(dirpath, name)
+                dpath = os.path.join(target_dir, name)
+                if os.path.islink(spath):
+                    relink(spath, dpath)
+                    continue
+                mutable = (
+                    name in VENV_MUTABLE_NAMES or
+                    name.endswith(VENV_MUTABLE_SUFFIXES) or
+                    (dirpath == scripts and is_text(spath))
+                )
+                if mutable:
+                    with open(spath, "rb") as fp:
+                        data = fp.read()
+                    if old in data:
+                        data = data.replace(old, new)
+                        report["fixed"] += 1
+                    with open(dpath, "wb") as fp:
+                        fp.write(data)
+                    shutil.copymode(spath, dpath)
+                    report["copied"] += 1
+                    continue
+                try:
+                    link(spath, dpath)
+                    report["linked"] += 1
+                except (TypeError, OSError):  # no link function or EXDEV
+                    shutil.copy2(spath, dpath)
+                    report["copied"] += 1
+        os.rename(building, dest)
+    finally:
+        if os.path.isdir(building):
+            shutil.rmtree(building, ignore_errors=True)
+    report["duration"] = time.time() - start
+    return report
+
+
+def isolate(wrkpath):
+    """Give to the deploy *wrkpath* its own virtualenv cloned from the
+    launcher one (if has not one yet). Returns its path
+
+    """
+    venv = isolated_venv_path(wrkpath)
+    if not os.path.isdir(venv):
+        if not os.path.isdir(cons.DEPLOY_VENVS_PATH):
+            os.makedirs(cons.DEPLOY_VENVS_PATH)
+        report = clone_venv(cons.LAUNCHER_VENV_PATH, venv)
+        logger.info(
+            "Virtualenv of '{}' cloned in {:.3f} sec ({} files linked, {} "
+            "copied)".format(wrkpath, report["duration"], report["linked"],
+                             report["copied"]))
+    return venv
+
+
+# =============================================================================
+# SNAPSHOTS
+# =============================================================================
+
+SNAPSHOT_FORMAT = 1
+
+SNAPSHOT_INDEX = "index.json"
+
+SNAPSHOT_ROOT = "venv"
+
+
+def venv_ok(venv=None):
+    """True if the interpreter of *venv* (the launcher one by default) is
+    there
+
+    """
+    return os.path.isfile(venv_paths(venv or cons.LAUNCHER_VENV_PATH)[1])
+
+
+def file_sha1(fpath):
+    digest = hashlib.sha1()
+    with open(fpath, "rb") as fp:
+        for chunk in iter(lambda: fp.read(64 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def snapshot_venv(venv, archive):
+    """Store the virtualenv *venv* in the compressed archive *archive*.
+
+    The first member is a json index with the original path (*prefix*) of
+    the virtualenv, the python version and platform, the sha1 of every file
+    and the text files that contain the prefix (the *fixups*: activate
+    scripts, shebangs, .pth). Files with the same content are stored only
+    once (the rest as hardlinks to the first one). Returns a report with
+    the *files*, the *unique* contents, the *bytes* of the archive and the
+    *duration*
+
+    """
+    start = time.time()
+    prefix = path_bytes(venv)
+    index = {
+        "format": SNAPSHOT_FORMAT, "prefix": venv,
+        "python": sys.version[:3], "platform": sys.platform,
+        "launcher": cons.str_version(), "files": {}, "fixups": []
+    }
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(venv):
+        for name in sorted(dirnames) + sorted(filenames):
+            fpath = os.path.join(dirpath, name)
+            rel = os.path.relpath(fpath, venv).replace(os.sep, "/")
+            entries.append((fpath, rel))
+            if os.path.isfile(fpath) and not os.path.islink(fpath):
+                index["files"][rel] = file_sha1(fpath)
+                if is_text(fpath):
+                    with open(fpath, "rb") as fp:
+                        if prefix in fp.read():
+                            index["fixups"].append(rel)
+
+    building = "{}.{}.partial".format(archive, os.getpid())
+    stored = {}
+    try:
+        with contextlib.closing(
+                tarfile.open(building, "w:gz", compresslevel=6)) as tar:
+            data = json.dumps(index, indent=1).encode("utf8")
+            info = tarfile.TarInfo(SNAPSHOT_INDEX)
+            info.size, info.mtime = len(data), time.time()
+            tar.addfile(info, io.BytesIO(data))
+            for fpath, rel in entries:
+                arcname = SNAPSHOT_ROOT + "/" + rel
+                sha1 = index["files"].get(rel)
+                if sha1 is not None and sha1 in stored:
+                    info = tar.gettarinfo(fpath, arcname)
+                    info.type, info.size = tarfile.LNKTYPE, 0
+                    info.linkname = stored[sha1]
+                    tar.addfile(info)
+                    continue
+                tar.add(fpath, arcname, recursive=False)
+                if sha1 is not None:
+                    stored[sha1] = arcname
+        if os.path.exists(archive):
+            os.remove(archive)
+        os.rename(building, archive)
+    finally:
+        if os.path.exists(building):
+            os.remove(building)
+    return {"files": len(index["files"]), "unique": len(stored),
+            "bytes": os.path.getsize(archive),
+            "duration": time.time() - start}
+
+
+def snapshot_index(archive):
+    """The index of the snapshot *archive* (only the first member is read)
+    or None if is not a valid snapshot
+
+    """
+    try:
+        with contextlib.closing(tarfile.open(archive, "r|gz")) as tar:
+            member = tar.next()
+            if member is None or member.name != SNAPSHOT_INDEX:
+                return None
+            index = json.loads(tar.extractfile(member).read().decode("utf8"))
+    except (IOError, OSError, tarfile.TarError, ValueError, EOFError):
+        return None
+    return index if index.get("format") == SNAPSHOT_FORMAT else None
+
+
+def snapshot_usable(archive=None):
+    """True if *archive* (the launcher snapshot by default) can be restored
+    by this interpreter
+
+    """
+    index = snapshot_index(archive or cons.VENV_SNAPSHOT_PATH)
+    return bool(index) and index["python"] == sys.version[:3] and \
+        index["platform"] == sys.platform
+
+
+def restore_venv(archive, dest):
+    """Restore the snapshot *archive* into *dest* (replaced if exists) with
+    one streaming extraction: the files listed as fixups are written with
+    the original prefix replaced by *dest*, the symbolic links pointing
+    inside the original virtualenv are retargeted and the files stored
+    once for many paths are copied to every one. Returns a report with
+    the *files*, the *fixed* ones and the *duration*
+
+    """
+    start = time.time()
+    report = {"files": 0, "fixed": 0}
+    building = "{}.{}.restoring".format(dest, os.getpid())
+    try:
+        with contextlib.closing(tarfile.open(archive, "r|gz")) as tar:
+            member = tar.next()
+            if member is None or member.name != SNAPSHOT_INDEX:
+                raise ValueError("'{}' is not a snapshot".format(archive))
+            index = json.loads(tar.extractfile(member).read().decode("utf8"))
+            prefix = index["prefix"]
+            old, new = path_bytes(prefix), path_bytes(dest)
+            fixups = set(index["fixups"])
+            os.makedirs(building)
+            encoding = sys.getfilesystemencoding() or cons.ENCODING
+            for member in iter(tar.next, None):
+                name, linkname = [
+                    value.decode(encoding) if isinstance(value, bytes)
+                    else value for value in (member.name, member.linkname)]
+                parts = name.split("/")
+                if parts[0] != SNAPSHOT_ROOT or ".." in parts or \
+                   name.startswith("/"):
+                    raise ValueError("Unexpected member '{}'".format(name))
+                rel = "/".join(parts[1:])
+                target = os.path.join(building, *parts[1:])
+                if member.isdir():
+                    os.makedirs(target)
+                elif member.issym():
+                    link = linkname
+                    if link == prefix or link.startswith(prefix + os.sep):
+                        link = dest + link[len(prefix):]
+                    os.symlink(link, target)
+                elif member.islnk():
+                    # a copy: a hardlink would share the file with others
+                    # that only have the same content
+                    source = os.path.join(building, *linkname.split("/")[1:])
+                    shutil.copy2(source, target)
+                    report["files"] += 1
+                elif member.isfile():
+                    stream = tar.extractfile(member)
+                    with open(target, "wb") as fp:
+                        if rel in fixups:
+                            fp.write(stream.read().replace(old, new))
+                            report["fixed"] += 1
+                        else:
+                            shutil.copyfileobj(stream, fp, 64 * 1024)
+                    os.chmod(target, member.mode)
+                    os.utime(target, (member.mtime, member.mtime))
+                    report["files"] += 1
+        if os.path.isdir(dest):
+            shutil.rmtree(dest)
+        os.rename(building, dest)
+    finally:
+        if os.path.isdir(building):
+            shutil.rmtree(building, ignore_errors=True)
+    report["duration"] = time.time() - start
+    return report
+
+
+def snapshot_launcher_venv(runner=None):
+    """Snapshot the launcher virtualenv (errors are only logged, the
+    snapshot is an optimization)
+
+    """
+    try:
+        report = snapshot_venv(cons.LAUNCHER_VENV_PATH,
+                               cons.VENV_SNAPSHOT_PATH)
+    except Exception as err:
+        logger.warning("Can't snapshot the virtualenv: {}".format(err))
+        return None
+    logger.info(
+        "Virtualenv snapshot: {} files ({} unique), {} bytes in {:.3f} "
+        "sec".format(report["files"], report["unique"], report["bytes"],
+                     report["duration"]))
+    return report
+
+
+def restore_launcher_venv():
+    """Restore the launcher virtualenv from its snapshot"""
+    report = restore_venv(cons.VENV_SNAPSHOT_PATH, cons.LAUNCHER_VENV_PATH)
+    logger.info("Virtualenv restored: {} files ({} fixed) in {:.3f} "
+                "sec".format(report["files"], report["fixed"],
+                             report["duration"]))
+    return report
+
+
+# =============================================================================
+# WHEELHOUSE
+# =============================================================================
+
+def canonical_name(name):
+    """Project name as is written in the wheel file names"""
+    return re.sub(r"[-_.]+", "_", name).lower()
+
+
+def parse_requirements(fpath):
+    """Return a dict with the canonical name of every project required in
+    *fpath* and the pinned version (or None)
+
+    """
+    required = {}
+    with codecs.open(fpath, encoding=cons.ENCODING) as fp:
+        for line in fp:
+            line = line.split("#", 1)[0].strip()
+            match = re.match(r"^([A-Za-z0-9][A-Za-z0-9._-]*)\s*(==\s*(\S+))?",
+                             line)
+            if line and not line.startswith("-") and match:
+                required[canonical_name(match.group(1))] = match.group(3)
+    return required
+
+
+def wheel_info(fname):
+    """Canonical name and version of a wheel file name (or None)"""
+    parts = fname[:-len(".whl")].split("-")
+    if not fname.endswith(".whl") or len(parts) < 5:
+        return None
+    return canonical_name(parts[0]), parts[1]
+
+
+def touch_wheels(fpath, wheelhouse=None):
+    """Mark as recently used the wheels (and source distributions) of pip,
+    wheel and the projects required by the requirements file *fpath*.
+    Returns their paths
+
+    """
+    wheelhouse = wheelhouse or cons.WHEELHOUSE_PATH
+    required = parse_requirements(fpath)
+    required.setdefault("pip", None)  # always installed in the venvs
+    required.setdefault("wheel", None)
+    used = []
+    for fname in os.listdir(wheelhouse):
+        info = wheel_info(fname) or sdist_info(fname)
+        if info and info[0] in required and \
+           required[info[0]] in (None, info[1]):
+            wpath = os.path.join(wheelhouse, fname)
+            os.utime(wpath, None)
+            used.append(wpath)
+    return used
+
+
+def evict_wheels(max_size=None, keep=(), wheelhouse=None):
+    """Remove the least recently used wheels (by modification time) until
+    the wheelhouse is under *max_size* bytes; the ones in *keep* and the
+    downloads in progress are never removed. Returns the removed paths
+
+    """
+    max_size = cons.WHEELHOUSE_MAX_SIZE if max_size is None else max_size
+    wheelhouse = wheelhouse or cons.WHEELHOUSE_PATH
+    wheels = []
+    for fname in os.listdir(wheelhouse):
+        wpath = os.path.join(wheelhouse, fname)
+        if not fname.endswith(".part") and os.path.isfile(wpath):
+            stat = os.stat(wpath)
+            wheels.append((stat.st_mtime, stat.st_size, wpath))
+    total = sum(size for _, size, _ in wheels)
+    removed = []
+    for _, size, wpath in sorted(wheels):
+        if total <= max_size:
+            break
+        if wpath in keep:
+            continue
+        os.remove(wpath)
+        total -= size
+        removed.append(wpath)
+    if removed:
+        logger.info("{} wheels removed from the wheelhouse".format(
+            len(removed)))
+    return removed
+
+
+def clean_partials(max_age=None, wheelhouse=None):
+    """Remove the unfinished downloads older than *max_age* seconds (left
+    by a launcher that died while prefetching). Returns the removed paths
+
+    """
+    max_age = cons.WHEELHOUSE_PARTIAL_MAX_AGE if max_age is None else max_age
+    wheelhouse = wheelhouse or cons.WHEELHOUSE_PATH
+    limit = time.time() - max_age
+    removed = []
+    for fname in os.listdir(wheelhouse):
+        fpath = os.path.join(wheelhouse, fname)
+        if fname.endswith(".part") and os.path.getmtime(fpath) < limit:
+            os.remove(fpath)
+            removed.append(fpath)
+    return removed
+
+
+def prepare_wheelhouse(reqpath):
+    """Mark the wheels needed by *reqpath* as used and make room for new
+    ones
+
+    """
+    cons.ensure_dirs()
+    try:
+        clean_partials()
+        evict_wheels(keep=touch_wheels(reqpath))
+    except (IOError, OSError) as err:
+        logger.warning("Can't prepare the wheelhouse: {}".format(err))
+
+
+# =============================================================================
+# PREFETCH
+# =============================================================================
+
+# : Python tags of the pure wheels that can be installed by this interpreter
+PYTHON_TAGS = (
+    "py{}".format(sys.version_info[0]),
+    "py{}{}".format(*sys.version_info[:2]),
+    "cp{}{}".format(*sys.version_info[:2])
+)
+
+SDIST_EXTENSIONS = (".tar.gz", ".tar.bz2", ".zip")
+
+# : A file of the index with the *checksum* given in the url fragment as
+# : ``(algorithm, hexdigest)`` or None
+IndexLink = collections.namedtuple(
+    "IndexLink", ["filename", "url", "checksum"]
+)
+
+
+class IndexLinksParser(HTMLParser.HTMLParser):
+    """Collect the href of every anchor of a simple index page"""
+
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.hrefs = []
+
+    def handle_starttag(self, tag, attrs):
+        href = dict(attrs).get("href")
+        if tag == "a" and href:
+            self.hrefs.append(href)
+
+
+def index_links(name, index_url=None, timeout=cons.PREFETCH_TIMEOUT):
+    """Return the IndexLink of every file of the project *name* in the
+    simple index *index_url* (PEP 503)
+
+    """
+    index_url = (index_url or cons.PREFETCH_INDEX_URL).rstrip("/") + "/"
+    page_url = urlparse.urljoin(
+        index_url, re.sub(r"[-_.]+", "-", name).lower() + "/")
+    with ctx.urlget(page_url, timeout=timeout) as response:
+        parser = IndexLinksParser()
+        parser.feed(response.read().decode(cons.ENCODING, "replace"))
+    links = []
+    for href in parser.hrefs:
+        url, fragment = urlparse.urldefrag(urlparse.urljoin(page_url, href))
+        algorithm, _, digest = fragment.partition("=")
+        checksum = None
+        if digest and algorithm in hashlib.algorithms:
+            checksum = (algorithm, digest.lower())
+        filename = urllib2.unquote(urlparse.urlsplit(url).path.split("/")[-1])
+        links.append(IndexLink(filename, url, checksum))
+    return links
+
+
+def sdist_info(fname):
+    """Canonical name and version of a source distribution file name (or
+    None)
+
+    """
+    for ext in SDIST_EXTENSIONS:
+        if fname.endswith(ext):
+            name, _, version = fname[:-len(ext)].rpartition("-")
+            return (canonical_name(name), version) if name else None
+    return None
+
+
+def pick_distribution(links, name, version):
+    """The link to download *name* == *version*: a pure wheel for this
+    interpreter if there is one or the source distribution. None if the
+    index has none of them
+
+    """
+    expected = (canonical_name(name), version)
+    sdist = None
+    for link in links:
+        if wheel_info(link.filename) == expected:
+            pytags, abi, platform = link.filename[:-4].split("-")[-3:]
+            if platform == "any" and \
+               set(pytags.split(".")).intersection(PYTHON_TAGS):
+                return link
+        elif sdist is None and sdist_info(link.filename) == expected:
+            sdist = link
+    return sdist
+
+
+def checksum_ok(fpath, checksum):
+    """True if the file *fpath* exists and match *checksum* (if any)"""
+    if not os.path.isfile(fpath):
+        return False
+    if checksum is None:
+        return True
+    digest = hashlib.new(checksum[0])
+    with open(fpath, "rb") as fp:
+        for chunk in iter(lambda: fp.read(64 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest() == checksum[1]
+
+
+def download(link, dest, timeout=cons.PREFETCH_TIMEOUT):
+    """Download *link* into the directory *dest* verifying its checksum.
+    The file is written with a temporary name and renamed when is complete.
+    Returns the bytes downloaded
+
+    """
+    fpath = os.path.join(dest, link.filename)
+    partial = "{}.{}.part".format(fpath, threading.current_thread().ident)
+    digest = hashlib.new(link.checksum[0]) if link.checksum else None
+    size = 0
+    try:
+        with ctx.urlget(link.url, timeout=timeout) as response:
+            with open(partial, "wb") as fp:
+                for chunk in iter(lambda: response.read(64 * 1024), b""):
+                    fp.write(chunk)
+                    size += len(chunk)
+                    if digest is not None:
+                        digest.update(chunk)
+        if digest is not None and digest.hexdigest() != link.checksum[1]:
+            raise ChecksumError(
+                "Checksum mismatch of '{}'".format(link.filename))
+        if os.path.exists(fpath):
+            os.remove(fpath)
+        os.rename(partial, fpath)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    return size
+
+
+class Prefetcher(object):
+    """Download concurrently, with at most *workers* threads, the pinned
+    requirements into the directory *dest* (the wheelhouse by default) so
+    pip can install them with ``--find-links`` without going to the network
+    once per package.
+
+    Every project is resolved in the simple index *index_url* and
+    downloaded with up to *retries* attempts, waiting *backoff* seconds
+    after the first failure and doubling it after each one. The projects
+    not pinned (``name==version``) are left to pip
+
+    """
+
+    def __init__(self, dest=None, index_url=None,
+                 workers=cons.PREFETCH_WORKERS,
+                 retries=cons.PREFETCH_RETRIES,
+                 backoff=cons.PREFETCH_BACKOFF,
+                 timeout=cons.PREFETCH_TIMEOUT):
+        self.dest = dest or cons.WHEELHOUSE_PATH
+        self.index_url = index_url
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+    def available(self, name, version):
+        """True if *dest* already has a distribution of name == version"""
+        expected = (canonical_name(name), version)
+        return any(
+            wheel_info(fname) == expected or sdist_info(fname) == expected
+            for fname in os.listdir(self.dest)
         )
-    else:
-        script = "\n".join([l.strip() for l in src.splitlines()])
-    return script.strip() + "\n"
+
+    def fetch(self, name, version):
+        """Resolve and download one project retrying on network and
+        checksum errors (not if the index has no such project or
+        distribution). Returns the file name and the bytes downloaded, or
+        None as bytes if *dest* already has the file with the checksum of
+        the index (or has a distribution and the index is unreachable)
+
+        """
+        delay = self.backoff
+        for attempt in range(1, self.retries + 1):
+            try:
+                try:
+                    links = index_links(name, self.index_url, self.timeout)
+                except IOError as err:
+                    if not self.available(name, version):
+                        raise
+                    logger.warning(
+                        "Using '{}=={}' from the wheelhouse without "
+                        "verification ({})".format(name, version, err))
+                    return None, None
+                link = pick_distribution(links, name, version)
+                if link is None:
+                    raise LookupError("No distribution of '{}=={}'".format(
+                        name, version))
+                fpath = os.path.join(self.dest, link.filename)
+                if checksum_ok(fpath, link.checksum):
+                    return link.filename, None
+                if os.path.exists(fpath):
+                    logger.warning("Checksum mismatch of '{}', downloading "
+                                   "it again".format(link.filename))
+                return link.filename, download(link, self.dest, self.timeout)
+            except IOError as err:
+                permanent = isinstance(err, urllib2.HTTPError) and \
+                    400 <= err.code < 500
+                if permanent or attempt == self.retries:
+                    raise
+                logger.warning("Retrying '{}' in {} sec ({})".format(
+                    name, delay, err))
+                time.sleep(delay)
+                delay *= 2
+
+    def run(self, requirements):
+        """Prefetch the requirements (a dict as returned by
+        ``parse_requirements``) and return a report with the files
+        downloaded, the *failed* projects, the total bytes and the duration
+
+        """
+        start = time.time()
+        if not os.path.isdir(self.dest):
+            os.makedirs(self.dest)
+        pending = Queue.Queue()
+        for name, version in sorted(requirements.items()):
+            if version:
+                pending.put((name, version))
+        report = {"files": [], "failed": {}, "bytes": 0, "skipped":
+                  len(requirements) - pending.qsize()}
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                try:
+                    name, version = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    fname, size = self.fetch(name, version)
+                except Exception as err:
+                    with lock:
+                        report["failed"][name] = unicode(err)
+                    continue
+                with lock:
+                    if size is None:
+                        report["skipped"] += 1
+                        continue
+                    report["files"].append(fname)
+                    report["bytes"] += size
+
+        threads = []
+        for idx in range(min(self.workers, pending.qsize())):
+            thread = threading.Thread(
+                target=worker, name="prefetch-{}".format(idx))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        report["duration"] = time.time() - start
+        logger.info(
+            "Prefetched {} files ({} bytes) in {:.3f} sec, {} failed".format(
+                len(report["files"]), report["bytes"], report["duration"],
+                len(report["failed"])))
+        return report
+
+
+def prefetch(reqpath, **kwargs):
+    """Prefetch the pinned requirements of *reqpath* (see Prefetcher)"""
+    cons.ensure_dirs()
+    return Prefetcher(**kwargs).run(parse_requirements(reqpath))
 
 
 # =============================================================================
 # LOGIC ITSELF
 # =============================================================================
 
-def create_virtualenv():
-    """Create otree virtualenv
+def offline_setup_possible():
+    """True if the launcher virtualenv can be created without network: there
+    is a usable snapshot or a wheelhouse and the last requirements file
+    downloaded
+
+    """
+    if snapshot_usable():
+        return True
+    if db.cache_get("venv_requirements") is None:
+        return False
+    try:
+        fnames = os.listdir(cons.WHEELHOUSE_PATH)
+    except OSError:
+        return False
+    return any(wheel_info(fname) or sdist_info(fname) for fname in fnames)
+
+
+def create_virtualenv(restore=True):
+    """Create otree virtualenv. If *restore* and there is a snapshot usable
+    (see ``snapshot_launcher_venv``) the virtualenv is restored from it
+    instead
 
     """
+    if restore and snapshot_usable():
+        logger.info("Restoring virtualenv in '{}' from '{}'...".format(
+            cons.LAUNCHER_VENV_PATH, cons.VENV_SNAPSHOT_PATH))
+        return StepRunner(
+            [func_step("restore-virtualenv", restore_launcher_venv)],
+            "create_virtualenv")
+
     logger.info(
         "Creating virtualenv in '{}'...".format(cons.LAUNCHER_VENV_PATH)
     )
@@ -160,51 +1892,126 @@ def create_virtualenv():
     reqpath = None
     with ctx.tempfile("requirements", "txt") as fpath:
         logger.info("Downloading requirements file...")
-        with ctx.urlget(cons.VENV_REQUIREMENTS_URL) as response:
-            with ctx.open(fpath, "w") as fp:
-                fp.write(response.read())
+        try:
+            with ctx.urlget(cons.VENV_REQUIREMENTS_URL) as response:
+                requirements = response.read().decode(cons.ENCODING)
+            db.cache_set("venv_requirements", requirements)
+        except IOError as err:
+            requirements = db.cache_get("venv_requirements")
+            if requirements is None:
+                raise
+            logger.warning(
+                "Using the last requirements file downloaded ({})".format(err))
+        with ctx.open(fpath, "w") as fp:
+            fp.write(requirements)
         reqpath = fpath
+    prepare_wheelhouse(reqpath)
+
+    logger.info("Creating venv, please wait"
+                " (this may take a few minutes)...")
+    return StepRunner(
+        plan(cons.CREATE_VENV_CMDS_TEMPLATE, cons.LAUNCHER_VENV_PATH,
+             REQUIREMENTS_PATH=reqpath),
+        "create_virtualenv", prepare=lambda runner: prefetch(reqpath),
+        on_success=snapshot_launcher_venv
+    )
 
-    with ctx.tempfile("venv_installer", cons.SCRIPT_EXTENSION) as fpath:
-        logger.info("Creating virtualenv install script...")
-        with ctx.open(fpath, "w") as fp:
-            src = render(cons.CREATE_VENV_CMDS_TEMPLATE,
-                         cons.LAUNCHER_VENV_PATH, REQUIREMENTS_PATH=reqpath)
-            fp.write(src)
-        logger.info("Creating venv, please wait"
-                    " (this may take a few minutes)...")
-        return call([cons.INTERPRETER, fpath])
 
+def clone_argv(depth=cons.CLONE_DEPTH, branch=cons.CLONE_BRANCH, tag=None):
+    """Command that clones only the *branch* or the *tag* (the default
+    branch if none is given) with the last *depth* commits (all if is
+    None).
 
-def clone(wrkpath):
-    """Clone otree code into working dir
+    With git is a shallow single branch clone; the dulwich of the
+    virtualenv can't make shallow clones so without git *depth* is ignored
+    and the whole history of the ref is fetched
 
     """
-    logger.info("Cloning into '{}'...".format(wrkpath))
-    with ctx.tempfile("cloner", cons.SCRIPT_EXTENSION) as fpath:
-        logger.info("Creating cloner script...")
-        with ctx.open(fpath, "w") as fp:
-            src = render(cons.CLONE_CMDS_TEMPLATE, wrkpath)
-            fp.write(src)
-        logger.info("Cloning...")
-        return call([cons.INTERPRETER, fpath])
+    ref = tag or branch
+    if cons.git_available():
+        argv = ["git", "clone", "--single-branch"]
+        if depth:
+            argv.extend(["--depth", str(depth)])
+        if ref:
+            argv.extend(["--branch", ref])
+        return argv
+    if depth:
+        logger.info("git not found, the clone will have all the history")
+    argv = ["python", cons.DULWICH_CLONE_PATH]
+    if ref:
+        argv.extend(["--tag" if tag else "--branch", ref])
+    return argv
+
+
+def objects_size(wrkpath):
+    """Bytes of the git objects of the repository in *wrkpath* (right after
+    a clone, the bytes received)
+
+    """
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(
+            os.path.join(wrkpath, ".git", "objects")):
+        for fname in filenames:
+            size += os.path.getsize(os.path.join(dirpath, fname))
+    return size
 
 
-def install_requirements(wrkpath):
-    """Intall the requirements of the given deploy
+def clone(wrkpath, depth=cons.CLONE_DEPTH, branch=cons.CLONE_BRANCH,
+          tag=None):
+    """Clone otree code into working dir (see ``clone_argv``). When done the
+    runner has a *report* with the bytes received and the duration
 
     """
-    logger.info(
-        "Installing requirements in '{}'...".format(cons.LAUNCHER_VENV_PATH)
+    logger.info("Cloning into '{}'...".format(wrkpath))
+
+    def report(runner):
+        runner.report = {
+            "bytes": objects_size(wrkpath),
+            "depth": depth if cons.git_available() else None,
+            "ref": tag or branch,
+            "duration": sum(rec["duration"] for rec in runner.records)
+        }
+        logger.info("Cloned {} bytes in {:.3f} sec".format(
+            runner.report["bytes"], runner.report["duration"]))
+
+    return StepRunner(
+        plan(cons.CLONE_CMDS_TEMPLATE, wrkpath,
+             CLONE_CMD=clone_argv(depth, branch, tag)),
+        "clone", on_success=report
     )
-    with ctx.tempfile("req_installer", cons.SCRIPT_EXTENSION) as fpath:
-        logger.info("Creating requirements install script...")
-        with ctx.open(fpath, "w") as fp:
-            src = render(cons.INSTALL_REQUIREMENTS_CMDS_TEMPLATE, wrkpath)
-            fp.write(src)
+
+
+def install_requirements(wrkpath, force=False, isolated=False,
+                         inputs=None):
+    """Intall the requirements of the given deploy. Nothing is run if the
+    last install succeeded with the same inputs (see
+    ``requirements_inputs``) unless *force*; *inputs* are the current ones
+    if the caller already computed them.
+
+    If *isolated* the deploy gets first its own virtualenv (see
+    ``isolate``) if has not one yet
+
+    """
+    name = "install_requirements"
+    venv = isolated_venv_path(wrkpath) if isolated else deploy_venv(wrkpath)
+    compute = functools.partial(requirements_inputs, wrkpath, venv)
+    if inputs is None and not force:
+        inputs = compute()
+    reqpath = os.path.join(wrkpath, cons.REQUIREMENTS_FNAME)
+    if force or not is_memoized(name, wrkpath, inputs):
+        logger.info("Installing requirements in '{}'...".format(venv))
         logger.info("Installing, please wait"
                     "(this may take a few minutes)...")
-        return call([cons.INTERPRETER, fpath])
+        if os.path.isfile(reqpath):
+            prepare_wheelhouse(reqpath)
+    steps = plan(cons.INSTALL_REQUIREMENTS_CMDS_TEMPLATE, wrkpath,
+                 VENV_PATH=venv)
+    if isolated:
+        steps.insert(0, func_step(
+            "clone-virtualenv", functools.partial(isolate, wrkpath)))
+    return run_memoized(name, steps, wrkpath, compute, force,
+                        prepare=lambda runner: prefetch(reqpath),
+                        current=inputs)
 
 
 def reset_db(wrkpath):
@@ -212,27 +2019,21 @@ def reset_db(wrkpath):
 
     """
     logger.info("Reset oTree in '{}'...".format(wrkpath))
-    with ctx.tempfile("reseter", cons.SCRIPT_EXTENSION) as fpath:
-        logger.info("Creating reset script...")
-        with ctx.open(fpath, "w") as fp:
-            src = render(cons.RESET_CMDS_TEMPLATE, wrkpath)
-            fp.write(src)
-        logger.info("Resetting (please wait)...")
-        return call([cons.INTERPRETER, fpath])
+    logger.info("Resetting (please wait)...")
+    return run_steps("reset_db", cons.RESET_CMDS_TEMPLATE, wrkpath,
+                     VENV_PATH=deploy_venv(wrkpath))
 
 
-def runserver(wrkpath):
-    """Run otree of the working path installation
+def runserver(wrkpath, port=None):
+    """Run otree of the working path installation listening in *port*
+    (OTREE_PORT by default)
 
     """
-    logger.info("Running oTree in '{}'...".format(wrkpath))
-    with ctx.tempfile("runner", cons.SCRIPT_EXTENSION) as fpath:
-        logger.info("Creating runner script...")
-        with ctx.open(fpath, "w") as fp:
-            src = render(cons.RUN_CMDS_TEMPLATE, wrkpath)
-            fp.write(src)
-        logger.info("Starting...")
-        return call([cons.INTERPRETER, fpath])
+    port = cons.OTREE_PORT if port is None else port
+    logger.info("Running oTree in '{}' on port {}...".format(wrkpath, port))
+    return run_steps(
+        server_source(port), cons.RUN_CMDS_TEMPLATE, wrkpath, PORT=port,
+        VENV_PATH=deploy_venv(wrkpath))
 
 
 def open_terminal(wrkpath):
@@ -244,7 +2045,8 @@ def open_terminal(wrkpath):
         logger.info("Creating open terminal script...")
         with ctx.open(fpath, "w") as fp:
             src = render(
-                cons.OPEN_TERMINAL_CMDS_TEMPLATE, wrkpath, decorate=False
+                cons.OPEN_TERMINAL_CMDS_TEMPLATE, wrkpath,
+                VENV_PATH=deploy_venv(wrkpath)
             )
             fp.write(src)
         logger.info("Launching Terminal...")
@@ -259,9 +2061,7 @@ def open_filemanager(wrkpath):
     with ctx.tempfile("open_filemanager", cons.SCRIPT_EXTENSION) as fpath:
         logger.info("Creating open filemanager script...")
         with ctx.open(fpath, "w") as fp:
-            src = render(
-                cons.OPEN_FILEMANAGER_CMDS_TEMPLATE, wrkpath, decorate=False
-            )
+            src = render(cons.OPEN_FILEMANAGER_CMDS_TEMPLATE, wrkpath)
             fp.write(src)
         logger.info("Launching filemanager...")
         return call([cons.INTERPRETER, fpath])
@@ -292,59 +2092,86 @@ def clean_logs(older_than=7):
                 os.remove(fpath)
 
 
-def logfile_fp(rewind=False):
-    """Open and return the log file used for external process"""
-
-    logger.info("Opening log file '{}'...".format(cons.LOG_FPATH))
-
-    if not os.path.exists(cons.LOG_FPATH):
-        with open(cons.LOG_FPATH, "w"):
-            pass
-
-    fp = open(cons.LOG_FPATH)
-    if not rewind:
-        fp.seek(0, 2)
-    return fp
-
-
 def clean_tempdir():
     """Destroy all files inside the temporary directory"""
     logger.info("Cleaning temp dir '{}'".format(cons.LAUNCHER_TEMP_DIR_PATH))
+    cons.ensure_dirs()
     for fname in os.listdir(cons.LAUNCHER_TEMP_DIR_PATH):
         fpath = os.path.join(cons.LAUNCHER_TEMP_DIR_PATH, fname)
         if os.path.isfile(fpath):
             os.remove(fpath)
 
 
+def fetch_last_version():
+    """Download the version file of the last release of oTree-Launcher.
+
+    The validators (ETag and Last-Modified) of the previous response are
+    stored in the launcher database and sent back, so if the file does not
+    change the server answers with an empty 304.
+
+    Returns: data
+
+    """
+    cache_key = "upgrade"
+    cached = db.cache_get(cache_key)
+
+    request = urllib2.Request(cons.LASTEST_VERSION_URL)
+    if cached and cached["etag"]:
+        request.add_header("If-None-Match", cached["etag"])
+    if cached and cached["last_modified"]:
+        request.add_header("If-Modified-Since", cached["last_modified"])
+
+    try:
+        with ctx.urlget(request, timeout=cons.UPGRADE_TIMEOUT) as response:
+            data = json.load(response)
+            headers = response.info()
+    except urllib2.HTTPError as err:
+        if cached and err.code == 304:
+            return cached["data"]
+        raise
+
+    db.cache_set(cache_key, {
+        "data": data, "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified")
+    })
+    return data
+
+
+def set_upgrade_notified(last_version):
+    """Store that the user was already told about *last_version*"""
+    db.cache_set("upgrade_notified", last_version)
+
+
 def check_upgrade():
     """Chek if a new version of oTree-Launcher is available and if mandatory
     to upgrade the program
 
-    Returns: last_version, is_new, mandatory
+    Returns: last_version, is_new, mandatory, notified (if the user was
+    already told about last_version, see ``set_upgrade_notified``)
     """
-    version = list(cons.VERSION)
-    with ctx.urlget(cons.LASTEST_VERSION_URL) as response:
-        data = json.load(response)
+    version = list(cons.version())
+    data = fetch_last_version()
 
-        lversion = data["version"]
-        str_lversion = ".".join(lversion)
+    lversion = data["version"]
+    str_lversion = ".".join(lversion)
 
-        exists_upgrade = version < lversion
+    exists_upgrade = version < lversion
 
-        mcondition = data["mandatory"]["condition"]
-        mvalue = data["mandatory"]["value"]
+    mcondition = data["mandatory"]["condition"]
+    mvalue = data["mandatory"]["value"]
 
-        mandatory = {
-            "==": version == mvalue,
-            "<": version < mvalue,
-            "<=": version <= mvalue,
-            ">": version > mvalue,
-            ">=": version >= mvalue,
-            "!=": version != mvalue,
-            "in": version in mvalue
-        }[mcondition]
+    mandatory = {
+        "==": version == mvalue,
+        "<": version < mvalue,
+        "<=": version <= mvalue,
+        ">": version > mvalue,
+        ">=": version >= mvalue,
+        "!=": version != mvalue,
+        "in": version in mvalue
+    }[mcondition]
 
-        return str_lversion, exists_upgrade, mandatory
+    notified = db.cache_get("upgrade_notified") == str_lversion
+    return str_lversion, exists_upgrade, mandatory, notified
 
 
 def check_py_version():
@@ -394,6 +2221,245 @@ def zip_info(fpath):
         ziph.writestr("cons.pkl", cons_as_pickle())
 
 
+# =============================================================================
+# SERVERS
+# =============================================================================
+
+def port_in_use(port, host="127.0.0.1"):
+    """True if a server can't listen in *port* now"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        if not cons.IS_WINDOWS:  # the same as the django server
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+    except socket.error:
+        return True
+    finally:
+        sock.close()
+    return False
+
+
+def free_port(preferred=None, exclude=()):
+    """Return *preferred* if is free, otherwise the first free port from
+    OTREE_PORT (skipping the *exclude* ones)
+
+    """
+    last = cons.OTREE_PORT + cons.OTREE_PORT_RANGE
+    candidates = range(cons.OTREE_PORT, last)
+    if preferred:
+        candidates.insert(0, preferred)
+    for port in candidates:
+        if port not in exclude and not port_in_use(port):
+            return port
+    raise IOError("No free port in {}-{}".format(cons.OTREE_PORT, last - 1))
+
+
+def server_source(port):
+    """Name of the output source of the server listening in *port*"""
+    return "runserver-{}".format(port)
+
+
+class ReadinessProbe(object):
+    """Wait until the server started at *start* answers at *url*.
+
+    Every try is a TCP connect to the port and, once is accepted, a HTTP GET
+    of *url* (any HTTP answer means that django is serving). The tries are
+    repeated with exponential backoff but a line of the output *source*
+    matching SERVER_READY_PATTERN retries at once. Gives up after *timeout*
+    seconds or when the process *proc* ends
+
+    """
+
+    def __init__(self, url, proc=None, source=None, start=None,
+                 timeout=cons.SERVER_READY_TIMEOUT):
+        self.url = url
+        self.proc = proc
+        self.source = source
+        self.start = time.time() if start is None else start
+        self.timeout = timeout
+        self.elapsed = None
+        self.hint = threading.Event()
+        self.pattern = re.compile(cons.SERVER_READY_PATTERN)
+        self.opener = urllib2.build_opener(urllib2.ProxyHandler({}))
+        if source:
+            OUTPUT.subscribe(self)
+
+    def __call__(self, source, timestamp, line):
+        if source == self.source and self.pattern.search(line):
+            self.hint.set()
+
+    def probe(self, timeout):
+        parts = urlparse.urlsplit(self.url)
+        try:
+            sock = socket.create_connection(
+                (parts.hostname, parts.port or 80), timeout)
+        except socket.error:
+            return False
+        sock.close()
+        try:
+            self.opener.open(self.url, timeout=timeout).close()
+        except urllib2.HTTPError:
+            pass  # answers, so is ready
+        except Exception:
+            return False
+        return True
+
+    def wait(self):
+        """Block until the server is ready and return the seconds since
+        *start* (or None if the process ends or the timeout expires)
+
+        """
+        deadline = self.start + self.timeout
+        delay = cons.READY_MIN_DELAY
+        try:
+            while time.time() < deadline:
+                if self.proc is not None and self.proc.poll() is not None:
+                    return None
+                if self.probe(min(delay * 2, cons.READY_MAX_DELAY)):
+                    self.elapsed = time.time() - self.start
+                    return self.elapsed
+                if self.hint.wait(delay):
+                    self.hint.clear()
+                    delay = cons.READY_MIN_DELAY
+                else:
+                    delay = min(delay * 2, cons.READY_MAX_DELAY)
+            return None
+        finally:
+            if self.source:
+                OUTPUT.unsubscribe(self)
+
+
+class Server(object):
+    """A running oTree server of the deploy in *path*"""
+
+    def __init__(self, path, port, proc):
+        self.path = path
+        self.port = port
+        self.proc = proc
+        self.url = cons.OTREE_URL_TEMPLATE.format(port=port)
+        self.started = time.time()
+        self.sampler = None
+        self.stopping = False
+        self.stop_report = None
+        self.probe = ReadinessProbe(
+            self.url, proc, server_source(port), self.started)
+
+    def wait_ready(self):
+        """Block until the server answers. Returns the seconds since the
+        start (and log them) or None if the server fails to start
+
+        """
+        elapsed = self.probe.wait()
+        if elapsed is None:
+            logger.warning("Server of '{}' not ready".format(self.path))
+        else:
+            logger.info("Server of '{}' ready in {:.3f} sec".format(
+                self.path, elapsed))
+        return elapsed
+
+    def __repr__(self):
+        return "<Server '{}' :{}>".format(self.path, self.port)
+
+
+class ServerPool(object):
+    """The oTree servers running at the same time, one per deploy and every
+    one in its own port.
+
+    The port used by a deploy is stored in the Deploy table and reused the
+    next time if is still free; the pid is stored while the server runs so
+    other launcher processes (the cli) can see and stop it
+
+    """
+
+    def __init__(self):
+        self.servers = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, path):
+        return self.get(path) is not None
+
+    def get(self, path):
+        """The Server of the deploy *path* if is running"""
+        with self._lock:
+            server = self.servers.get(path)
+        if server and not server.stopping and server.proc.poll() is not None:
+            self.discard(server)
+            return None
+        return server
+
+    def running(self):
+        return [
+            server for server in list(self.servers.values())
+            if self.get(server.path)
+        ]
+
+    def start(self, path, port=None):
+        """Run the server of the deploy *path* in *port* (that must be
+        free) or a free one
+
+        """
+        with self._lock:
+            if path in self.servers:
+                raise ValueError("'{}' is already running".format(path))
+            deploy = db.get_deploy(path, create=True)
+            used = set(server.port for server in self.servers.values())
+            if port is None:
+                port = free_port(deploy.port, exclude=used)
+            elif port in used or port_in_use(port):
+                raise ValueError("Port {} is already in use".format(port))
+            server = Server(path, port, runserver(path, port))
+            self.servers[path] = server
+        server.proc.spawned.wait(cons.SERVER_SPAWN_TIMEOUT)
+        deploy.port, deploy.pid, deploy.started = (
+            port, server.proc.pid, server.started)
+        deploy.save()
+        return server
+
+    def discard(self, server):
+        """Forget *server* (already finished or stopped). Returns False if
+        was already forgotten
+
+        """
+        with self._lock:
+            if self.servers.get(server.path) is not server:
+                return False
+            del self.servers[server.path]
+        if server.sampler is not None:
+            server.sampler.stop()
+        deploy = db.get_deploy(server.path)
+        if deploy is not None and deploy.started == server.started:
+            deploy.pid = deploy.started = None
+            deploy.save()
+        return True
+
+    def stop(self, path, grace=None, kill_grace=None):
+        """Stop the server of the deploy *path* (see stop_proc), wait until
+        its port is free and forget it. Returns the Server, with the report
+        of stop_proc in *stop_report*, or None if was not running
+
+        """
+        server = self.servers.get(path)
+        if server is None:
+            return None
+        server.stopping = True
+        report = stop_proc(server.proc, grace, kill_grace, server.port)
+        server.stop_report = report
+        self.discard(server)
+        logger.info("Server of '{}' stopped in {:.3f} sec{}{}".format(
+            path, report["duration"],
+            " (killed)" if report["killed"] else "",
+            "" if report["port_released"] else
+            ", the port {} is still in use".format(server.port)
+        ))
+        return server
+
+    def stop_all(self, grace=None, kill_grace=None):
+        """Stop all the servers at the same time"""
+        stoppers = TaskRunner()
+        for path in list(self.servers):
+            stoppers.add(path, self.stop, path, grace, kill_grace)
+        return [stoppers.result(path) for path in stoppers.tasks]
+
 
 # =============================================================================
 # MAIN
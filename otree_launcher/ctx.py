@@ -40,6 +40,7 @@ def tempfile(prefix, extension):
     """Create a temporary file in the wrkpath
 
     """
+    cons.ensure_dirs()
     fname = "{}_{}.{}".format(prefix, uuid.uuid4().int, extension)
     fpath = os.path.join(cons.LAUNCHER_TEMP_DIR_PATH, fname)
     yield fpath
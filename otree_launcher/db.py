@@ -22,6 +22,10 @@ from __future__ import unicode_literals
 # IMPORTS
 # =============================================================================
 
+import json
+import time
+import threading
+
 from . import cons
 from .libs import peewee
 
@@ -32,7 +36,37 @@ from .libs import peewee
 
 logger = cons.logger
 
-DB = peewee.SqliteDatabase(cons.DB_FPATH, threadlocals=True)
+# : Increase this number every time a model is added or changed
+SCHEMA_VERSION = 4
+
+
+# =============================================================================
+# DATABASE
+# =============================================================================
+
+class LauncherDatabase(peewee.SqliteDatabase):
+    """Sqlite database opened the first time is queried.
+
+    The first connection of the process bootstrap the schema if the version
+    stored in the database file is older than SCHEMA_VERSION
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(LauncherDatabase, self).__init__(*args, **kwargs)
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def connect(self):
+        cons.ensure_dirs()
+        super(LauncherDatabase, self).connect()
+        with self._schema_lock:
+            if not self._schema_ready:
+                bootstrap_schema()
+                self._schema_ready = True
+
+
+DB = LauncherDatabase(cons.DB_FPATH, threadlocals=True)
 
 
 # =============================================================================
@@ -56,11 +90,66 @@ class Configuration(BaseModel):
         super(Configuration, self).save(*args, **kwargs)
 
 
+class Deploy(BaseModel):
+    """Every deploy known by the launcher with the port of its server and
+    the pid of the server while is running
+
+    """
+
+    path = peewee.TextField(unique=True)
+    port = peewee.IntegerField(null=True)
+    pid = peewee.IntegerField(null=True)
+    started = peewee.FloatField(null=True)
+
+
+class StepMemo(BaseModel):
+    """The fingerprint of the inputs of the last successful run of a step
+    in a deploy
+
+    """
+
+    step = peewee.CharField()
+    path = peewee.TextField()
+    key = peewee.TextField()
+    succeeded = peewee.FloatField()
+
+    class Meta:
+        indexes = ((("step", "path"), True),)
+
+
+class Capability(BaseModel):
+
+    name = peewee.CharField(unique=True)
+    key = peewee.TextField()
+    available = peewee.BooleanField(default=False)
+
+
+class CacheEntry(BaseModel):
+
+    key = peewee.CharField(unique=True)
+    value = peewee.TextField()
+    updated = peewee.FloatField()
+    expires = peewee.FloatField(null=True)
+
+
 # =============================================================================
 # SETUP
 # =============================================================================
 
-DB.connect()
+def schema_version():
+    """Return the schema version stored in the database file"""
+    return DB.execute_sql("PRAGMA user_version").fetchone()[0]
+
+
+def bootstrap_schema():
+    """Create the tables only if the stored schema version is outdated"""
+    if schema_version() < SCHEMA_VERSION:
+        logger.info("Creating database schema v{}...".format(SCHEMA_VERSION))
+        create_tables()
+        for conf in Configuration.select():
+            if conf.path:
+                get_deploy(conf.path, create=True)
+        DB.execute_sql("PRAGMA user_version = {}".format(SCHEMA_VERSION))
 
 
 def create_tables():
@@ -73,7 +162,125 @@ def clear_database():
     DB.drop_tables(BaseModel.__subclasses__())
     create_tables()
 
-create_tables()
+
+# =============================================================================
+# DEPLOYS
+# =============================================================================
+
+def get_deploy(path, create=False):
+    """Return the Deploy of *path*; if not exists create it or return None
+
+    """
+    try:
+        return Deploy.get(Deploy.path == path)
+    except Deploy.DoesNotExist:
+        return Deploy.create(path=path) if create else None
+
+
+def deploys():
+    """All the known deploys ordered by path"""
+    return list(Deploy.select().order_by(Deploy.path))
+
+
+def remove_deploy(path):
+    Deploy.delete().where(Deploy.path == path).execute()
+    StepMemo.delete().where(StepMemo.path == path).execute()
+
+
+# =============================================================================
+# STEP MEMOS
+# =============================================================================
+
+def get_memo(step, path):
+    """Return the fingerprint of the last success of *step* in *path* or
+    None
+
+    """
+    try:
+        memo = StepMemo.get((StepMemo.step == step) & (StepMemo.path == path))
+    except StepMemo.DoesNotExist:
+        return None
+    return memo.key
+
+
+def set_memo(step, path, key):
+    """Store *key* as the fingerprint of the last success of *step* in
+    *path*
+
+    """
+    try:
+        memo = StepMemo.get((StepMemo.step == step) & (StepMemo.path == path))
+    except StepMemo.DoesNotExist:
+        memo = StepMemo(step=step, path=path)
+    memo.key = key
+    memo.succeeded = time.time()
+    memo.save()
+
+
+def clear_memo(step, path):
+    StepMemo.delete().where(
+        (StepMemo.step == step) & (StepMemo.path == path)).execute()
+
+
+# =============================================================================
+# CAPABILITIES
+# =============================================================================
+
+def get_capability(name, key):
+    """Return the stored result of the probe *name* or None if was never
+    probed or was probed with other key
+
+    """
+    try:
+        cap = Capability.get(Capability.name == name)
+    except Capability.DoesNotExist:
+        return None
+    return cap.available if cap.key == key else None
+
+
+def set_capability(name, key, available):
+    """Store the result of the probe *name* with the given key"""
+    try:
+        cap = Capability.get(Capability.name == name)
+    except Capability.DoesNotExist:
+        cap = Capability(name=name)
+    cap.key = key
+    cap.available = available
+    cap.save()
+
+
+# =============================================================================
+# CACHE
+# =============================================================================
+
+def cache_get(key):
+    """Return the value stored with *key* or None if not exists or is
+    expired
+
+    """
+    try:
+        entry = CacheEntry.get(CacheEntry.key == key)
+    except CacheEntry.DoesNotExist:
+        return None
+    if entry.expires is not None and entry.expires < time.time():
+        return None
+    return json.loads(entry.value)
+
+
+def cache_set(key, value, ttl=None):
+    """Store a json serializable *value* with the given *key* for *ttl*
+    seconds (None means forever)
+
+    """
+    try:
+        entry = CacheEntry.get(CacheEntry.key == key)
+    except CacheEntry.DoesNotExist:
+        entry = CacheEntry(key=key)
+    entry.value = json.dumps(value)
+    entry.updated = time.time()
+    entry.expires = None if ttl is None else entry.updated + ttl
+    entry.save()
+
 
 # =============================================================================
 # MAIN
@@ -25,24 +25,53 @@ import os
 import logging
 import sys
 import webbrowser
+import threading
+import functools
+import collections
 import time
+import Queue
 
 import Tkinter
 import tkMessageBox
 import tkFileDialog
 import ttk
 
-from . import cons, core, res
+from . import cons, core, db, res, monitor
 from .libs import splash, tktooltip
 
 
+# =============================================================================
+# PLATFORM IMPORTS
+# =============================================================================
+
+fcntl = None
+
+if not cons.IS_WINDOWS:
+    import fcntl
+
+
 # =============================================================================
 # CONSTANTS
 # =============================================================================
 
 logger = cons.logger
 
-WEB_BROWSER_WAIT = 5 * 1000
+DISPATCH_POLL = 25
+
+PREFLIGHT_TIMEOUT = 10
+
+# : The console is redrawn at most 30 times per second
+CONSOLE_FLUSH_INTERVAL = 1000 // 30
+
+CONSOLE_BUFFER_SIZE = 5000
+
+# : Lines kept in the console while it follows the end of the output
+CONSOLE_MAX_LINES = 2000
+
+# : Lines of the daily log loaded every time the console scrolls over the top
+CONSOLE_PAGE_LINES = 500
+
+SPARKLINE_HEIGHT = 30
 
 
 # =============================================================================
@@ -81,32 +110,235 @@ class MessageBox(object):
                 tkMessageBox.showinfo("Report ended", message)
 
 
+# =============================================================================
+# THREADS
+# =============================================================================
+
+class DispatchTimeout(Exception):
+    """Passed to the errback of a job that not ends in time"""
+
+
+class Dispatcher(object):
+    """Run jobs in background threads and their callbacks in the Tk thread.
+
+    The callbacks are passed through a thread safe queue. Where Tk can
+    watch file descriptors (every platform except Windows) each post writes
+    a byte in a pipe that wakes up the Tk loop at once, so nothing is
+    polled; otherwise the queue is polled every DISPATCH_POLL ms while some
+    job is still running. An idle launcher never wakes up
+
+    """
+
+    def __init__(self, widget):
+        self.widget = widget
+        self.queue = Queue.Queue()
+        self.jobs = []
+        self.timer = None
+        self.wakeup_fds = None
+        tk = getattr(widget, "tk", None)
+        if not cons.IS_WINDOWS and hasattr(tk, "createfilehandler"):
+            rfd, wfd = os.pipe()
+            for fd in (rfd, wfd):
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            tk.createfilehandler(rfd, Tkinter.READABLE, self._on_wakeup)
+            self.wakeup_fds = rfd, wfd
+
+    @property
+    def pending(self):
+        return len(self.jobs)
+
+    def submit(self, func, args=(), callback=None, errback=None,
+               timeout=None):
+        """Run ``func(*args)`` in a new thread. When ends call
+        ``callback(result)`` or ``errback(exception)`` in the Tk thread.
+
+        If the job is not finished after *timeout* seconds the errback
+        receives a DispatchTimeout and the late result is ignored
+
+        """
+        job = {
+            "callback": callback, "errback": errback,
+            "deadline": None if timeout is None else time.time() + timeout
+        }
+
+        def run():
+            try:
+                result = func(*args)
+            except Exception as err:
+                self.post(self._done, job, False, err)
+            else:
+                self.post(self._done, job, True, result)
+
+        self.jobs.append(job)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        self._schedule()
+
+    def post(self, func, *args):
+        """Call ``func(*args)`` in the Tk thread. Can be used from any
+        thread (without wakeup pipe only while a submitted job is running)
+
+        """
+        self.queue.put((func, args))
+        if self.wakeup_fds:
+            try:
+                os.write(self.wakeup_fds[1], b"\0")
+            except OSError:
+                pass  # the pipe is full, so the loop will wake up anyway
+
+    def _done(self, job, ok, value):
+        if job not in self.jobs:
+            return  # timed out before
+        self.jobs.remove(job)
+        handler = job["callback"] if ok else job["errback"]
+        if handler:
+            handler(value)
+
+    def _expire(self):
+        now = time.time()
+        for job in list(self.jobs):
+            if job["deadline"] is not None and job["deadline"] < now:
+                self._done(job, False, DispatchTimeout("Timed out"))
+
+    def _on_wakeup(self, fd, mask):
+        try:
+            while os.read(fd, 4096):
+                pass
+        except OSError:
+            pass
+        self._process()
+
+    def _on_timer(self):
+        self.timer = None
+        self._process()
+
+    def _process(self):
+        try:
+            while True:
+                try:
+                    func, args = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                func(*args)
+            self._expire()
+        finally:
+            self._schedule()
+
+    def _schedule(self):
+        """Program the next timer: the poll interval if there is no wakeup
+        pipe, or the nearest deadline of the running jobs
+
+        """
+        if self.timer is not None:
+            self.widget.after_cancel(self.timer)
+            self.timer = None
+        if not self.pending:
+            return
+        if self.wakeup_fds is None:
+            delay = DISPATCH_POLL
+        else:
+            deadlines = [
+                job["deadline"] for job in self.jobs
+                if job["deadline"] is not None
+            ]
+            if not deadlines:
+                return
+            delay = max(0, int((min(deadlines) - time.time()) * 1000) + 1)
+        self.timer = self.widget.after(delay, self._on_timer)
+
+
 # =============================================================================
 # LOGGER UI
 # =============================================================================
 
+def fold_lines(entries):
+    """Collapse the consecutive repeated lines of the (timestamp, line)
+    *entries* into one with a counter and the timestamp of the first
+
+    """
+    folded = []
+    for timestamp, line in entries:
+        if folded and folded[-1][1] == line:
+            folded[-1][2] += 1
+        else:
+            folded.append([timestamp, line, 1])
+    return [
+        (timestamp, "{} (x{})".format(line, count) if count > 1 else line)
+        for timestamp, line, count in folded
+    ]
+
+
 class LoggingToGUI(logging.Handler):
     """ Used to redirect logging output to the widget passed in parameters
 
+    The records are stored in a ring buffer of *size* lines and appended to
+    the LogDisplay *display* in batches every *interval* ms. Records emitted
+    outside the Tk thread arm the flush through the *dispatcher*.
+
     Based on http://goo.gl/LrxkGZ
 
     """
 
-    def __init__(self, console):
+    def __init__(self, display, dispatcher,
+                 interval=CONSOLE_FLUSH_INTERVAL, size=CONSOLE_BUFFER_SIZE):
         super(LoggingToGUI, self).__init__()
-        self.console = console
+        self.display = display
+        self.dispatcher = dispatcher
+        self.interval = interval
+        self.thread = threading.current_thread()
+        self.buffer = collections.deque(maxlen=size)
+        self.dropped = 0
+        self.armed = False
+        self.buffer_lock = threading.Lock()
 
     def format(self, msg):
         fmt = super(LoggingToGUI, self).format(msg)
-        return fmt.decode("ascii", "ignore")
+        if not isinstance(fmt, unicode):
+            fmt = fmt.decode("ascii", "ignore")
+        return fmt.encode("ascii", "ignore").decode("ascii")
 
     def emit(self, message):
-        formattedMessage = self.format(message)
-        self.console.configure(state=Tkinter.NORMAL)
-        self.console.insert(Tkinter.END, "> " + formattedMessage + "\n")
-        self.console.configure(state=Tkinter.DISABLED)
-        self.console.see(Tkinter.END)
-        self.console.update()
+        # only the last update of a progress line (after the last '\r')
+        line = "> " + self.format(message).rsplit("\r", 1)[-1]
+        timestamp = getattr(message, "stamp", message.created)
+        with self.buffer_lock:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.dropped += 1
+            self.buffer.append((timestamp, line))
+            if self.armed:
+                return
+            self.armed = True
+        if threading.current_thread() is self.thread:
+            self.arm()
+        else:
+            self.dispatcher.post(self.arm)
+
+    def arm(self):
+        self.display.after(self.interval, self.flush)
+
+    def flush(self):
+        with self.buffer_lock:
+            entries, dropped = list(self.buffer), self.dropped
+            self.buffer.clear()
+            self.dropped, self.armed = 0, False
+        if not entries:
+            return
+        if dropped:
+            entries.insert(0, (
+                entries[0][0], "> ... {} lines not shown (see '{}')".format(
+                    dropped, cons.LOG_FPATH)
+            ))
+        self.display.append(fold_lines(entries))
+
+
+def show_output(source, timestamp, line):
+    """Output subscriber that sends the lines of the processes to the
+    launcher logger (marked as output so they are not logged twice)
+
+    """
+    logger.info(line, extra={"output": True, "stamp": timestamp})
 
 
 # =============================================================================
@@ -114,25 +346,304 @@ class LoggingToGUI(logging.Handler):
 # =============================================================================
 
 class LogDisplay(ttk.LabelFrame):
-    """A simple 'console' to place at the bottom of a Tkinter window """
+    """A simple 'console' to place at the bottom of a Tkinter window
 
-    def __init__(self, root, **options):
+    At most *max_lines* lines are kept in the widget. While the view follows
+    the end the oldest lines are removed; scrolling over the top pages in
+    the previous *page_lines* lines of the daily log through a LogIndex.
+    While the view is scrolled up the newest lines are removed instead and
+    paged in again from the daily log when the view reaches the bottom, so
+    the memory used does not depend on the length of the session.
+
+    """
+
+    def __init__(self, root, max_lines=CONSOLE_MAX_LINES,
+                 page_lines=CONSOLE_PAGE_LINES, **options):
         ttk.LabelFrame.__init__(self, root, **options)
+        self.max_lines = max_lines
+        self.page_lines = page_lines
         self.console = Tkinter.Text(self, height=10)
         self.console.configure(state=Tkinter.DISABLED)
         self.console.configure(bg="#222222", fg="#dddddd")
         self.console.pack(fill=Tkinter.BOTH, expand=True)
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Prior>"):
+            self.console.bind(sequence, self.on_scroll_up, add="+")
+        for sequence in ("<MouseWheel>", "<Button-5>", "<Next>"):
+            self.console.bind(sequence, self.on_scroll_down, add="+")
+
+        # stamp ('HH:MM:SS.mmm') of every line after the paged history
+        self.stamps = collections.deque()
+
+        # lines of the daily log at the top and the index of the first one
+        self.history_lines = 0
+        self.history_start = None
+        self.index = None
+
+        # index in the daily log of the first line removed from the bottom
+        # (None if nothing is missing) and when the missing lines were paged
+        # in (the entries older than that are already in the widget)
+        self.tail_start = None
+        self.tail_loaded = None
+
+    def following(self):
+        return self.console.yview()[1] >= 1.0
+
+    def log_index(self):
+        if self.index is None:
+            self.index = core.LogIndex(cons.LOG_FPATH)
+        self.index.refresh()
+        return self.index
+
+    def stamps_start(self):
+        """Index in the daily log of the first line after the history: the
+        lines logged in the same millisecond as it and not in the widget
+        are the last ones before it
+
+        """
+        index = self.log_index()
+        first = self.stamps[0]
+        shown = 0
+        for stamp in self.stamps:
+            if stamp != first:
+                break
+            shown += 1
+        end = index.bisect(first)
+        while end < len(index) and index.stamp(end) in (first, ""):
+            end += 1
+        return max(0, end - shown)
+
+    def split(self, entries):
+        """The lines and stamps of the (timestamp, text) *entries*, one per
+        line of the widget (a text can have many)
+
+        """
+        lines, stamps = [], []
+        for timestamp, text in entries:
+            if self.tail_loaded is not None:
+                if timestamp <= self.tail_loaded:
+                    continue
+                self.tail_loaded = None
+            stamp = core.format_stamp(timestamp)
+            for line in text.split("\n"):
+                lines.append(line)
+                stamps.append(stamp)
+        return lines, stamps
+
+    def append(self, entries):
+        """Add the (timestamp, text) *entries* at the end"""
+        following = self.following()
+        if self.tail_start is not None:
+            if not following:
+                return  # paged in from the daily log when scrolled down
+            self.load_tail()
+        lines, stamps = self.split(entries)
+        if not lines:
+            return
+        self.console.configure(state=Tkinter.NORMAL)
+        self.console.insert(Tkinter.END, "\n".join(lines) + "\n")
+        self.stamps.extend(stamps)
+        if following:
+            self.trim()
+        else:
+            self.trim_bottom()
+        self.console.configure(state=Tkinter.DISABLED)
+        if following:
+            self.console.see(Tkinter.END)
+
+    def trim(self):
+        """Remove the oldest lines over *max_lines* (history first)"""
+        excess = self.history_lines + len(self.stamps) - self.max_lines
+        if excess <= 0:
+            return
+        self.console.delete("1.0", "{}.0".format(excess + 1))
+        from_history = min(excess, self.history_lines)
+        self.history_lines -= from_history
+        if self.history_lines:
+            self.history_start += from_history
+        else:
+            self.history_start = None
+        for _ in range(excess - from_history):
+            self.stamps.popleft()
+
+    def trim_bottom(self):
+        """Remove the newest lines over *max_lines* and remember where they
+        start in the daily log
+
+        """
+        total = self.history_lines + len(self.stamps)
+        excess = total - self.max_lines
+        if excess <= 0:
+            return
+        self.console.delete(
+            "{}.0".format(total - excess + 1), Tkinter.END)
+        from_stamps = min(excess, len(self.stamps))
+        if from_stamps:
+            first = self.stamps[-from_stamps]
+            for _ in range(from_stamps):
+                self.stamps.pop()
+            # the lines logged in the same millisecond still in the widget
+            kept = 0
+            for stamp in reversed(self.stamps):
+                if stamp != first:
+                    break
+                kept += 1
+            self.tail_start = self.log_index().bisect(first) + kept
+        if excess > from_stamps:
+            self.history_lines -= excess - from_stamps
+            self.tail_start = self.history_start + self.history_lines
+            if not self.history_lines:
+                self.history_start = None
+
+    def on_scroll_up(self, event):
+        if getattr(event, "delta", 0) < 0:  # <MouseWheel> down
+            return
+        if self.console.yview()[0] <= 0.0:
+            self.load_history()
+
+    def on_scroll_down(self, event):
+        if getattr(event, "delta", 0) > 0:  # <MouseWheel> up
+            return
+        if self.tail_start is not None and self.following():
+            self.load_tail()
+
+    def load_history(self):
+        """Insert at the top the lines of the daily log previous to the
+        oldest one in the console. Returns the number of lines loaded
+
+        """
+        index = self.log_index()
+        if self.history_start is not None:
+            end = self.history_start
+        elif self.stamps:
+            end = self.stamps_start()
+        elif self.tail_start is not None:
+            end = self.tail_start
+        else:
+            end = len(index)
+        start, lines = index.page(end, self.page_lines)
+        if not lines:
+            return 0
+        self.console.configure(state=Tkinter.NORMAL)
+        self.console.insert("1.0", "\n".join(lines) + "\n")
+        self.history_start, self.history_lines = (
+            start, self.history_lines + len(lines))
+        self.trim_bottom()
+        self.console.configure(state=Tkinter.DISABLED)
+        self.console.yview("{}.0".format(len(lines) + 1))
+        return len(lines)
+
+    def load_tail(self):
+        """Append the lines of the daily log removed from the bottom and the
+        ones logged since (only the last *max_lines*). Returns the number
+        of lines loaded
+
+        """
+        self.tail_loaded = time.time()
+        index = self.log_index()
+        end = len(index)
+        start = max(self.tail_start, end - self.max_lines)
+        self.tail_start = None
+        lines, stamps = [], []
+        for idx in range(start, end):
+            stamp = index.record_stamp(idx)
+            lines.append(index.line(idx))
+            stamps.append(stamp)
+        if not lines:
+            return 0
+        self.console.configure(state=Tkinter.NORMAL)
+        self.console.insert(Tkinter.END, "\n".join(lines) + "\n")
+        self.stamps.extend(stamps)
+        self.trim()
+        self.console.configure(state=Tkinter.DISABLED)
+        self.console.see(Tkinter.END)
+        return len(lines)
+
+
+class ResourceDisplay(ttk.LabelFrame):
+    """Sparkline of the cpu used by the server and the last sample of a
+    monitor.ResourceSampler, with a button to export all the samples as csv
+
+    """
+
+    def __init__(self, root, **options):
+        ttk.LabelFrame.__init__(self, root, **options)
+        self.sampler = None
+        self.timer = None
+        self.canvas = Tkinter.Canvas(
+            self, height=SPARKLINE_HEIGHT, bg="#222222",
+            highlightthickness=0)
+        self.canvas.pack(fill=Tkinter.X, expand=True, padx=2, pady=2)
+        self.summary = Tkinter.StringVar(value="Server not running")
+        ttk.Label(self, textvariable=self.summary).pack(
+            side=Tkinter.LEFT, padx=2)
+        self.export_button = ttk.Button(
+            self, text="Export CSV", command=self.do_export,
+            state=Tkinter.DISABLED)
+        self.export_button.pack(side=Tkinter.RIGHT, padx=2, pady=2)
+        tktooltip.create_tooltip(
+            self.export_button, "Save the samples of the server as csv")
+
+    def attach(self, sampler):
+        if sampler is self.sampler and self.timer is not None:
+            return
+        self.detach()
+        self.sampler = sampler
+        self.export_button.config(state=Tkinter.NORMAL)
+        self.refresh()
+
+    def detach(self):
+        """Stop refreshing (the samples are kept to be exported)"""
+        if self.timer is not None:
+            self.after_cancel(self.timer)
+            self.timer = None
+            self.summary.set("Server not running")
+
+    def refresh(self):
+        samples = list(self.sampler.samples)
+        self.draw([sample.cpu for sample in samples])
+        if samples:
+            last = samples[-1]
+            self.summary.set(
+                "CPU {:.0f}%  RSS {:.1f} MB  {} threads  {} fds".format(
+                    last.cpu, last.rss / 1048576., last.threads, last.fds)
+            )
+        self.timer = self.after(
+            int(self.sampler.interval * 1000), self.refresh)
+
+    def draw(self, values):
+        self.canvas.delete(Tkinter.ALL)
+        width = self.canvas.winfo_width()
+        values = values[-width // 2:]
+        if len(values) < 2:
+            return
+        top = max(100., max(values))
+        step = float(width) / (len(values) - 1)
+        height = SPARKLINE_HEIGHT - 2
+        points = []
+        for idx, value in enumerate(values):
+            points.extend([idx * step, 1 + height - value / top * height])
+        self.canvas.create_line(points, fill="#66cc66")
+
+    def do_export(self):
+        fpath = tkFileDialog.asksaveasfilename(
+            parent=self, defaultextension=".csv",
+            filetypes=[("csv files", ".csv"), ("all files", ".*")],
+            title="Export Server Resources")
+        if fpath:
+            count = self.sampler.to_csv(fpath)
+            logger.info("{} samples exported to '{}'".format(count, fpath))
 
 
 class OTreeLauncherFrame(ttk.Frame):
 
-    def __init__(self, root):
+    def __init__(self, root, conf=None):
         ttk.Frame.__init__(self, root)
         self.root = root
         self.proc = None
-        self.conf = core.get_conf()
-        self.last_connectivity_check = (None, None)  # status, time
+        self.servers = core.ServerPool()
+        self.conf = core.get_conf() if conf is None else conf
         self.msgbox = MessageBox(self)
+        self.dispatcher = Dispatcher(self)
 
         # icons
         self.icon_new = Tkinter.PhotoImage(file=res.get("imgs", "new.gif"))
@@ -195,10 +706,12 @@ class OTreeLauncherFrame(ttk.Frame):
         directory_frame.pack(fill=Tkinter.X)
 
         self.deploy_path = Tkinter.StringVar()
-        self.deploy_entry = ttk.Entry(
+        self.deploy_entry = ttk.Combobox(
             directory_frame, textvariable=self.deploy_path,
-            state=["readonly"]
+            state="readonly"
         )
+        self.deploy_entry.bind(
+            "<<ComboboxSelected>>", self.do_select_deploy)
         self.deploy_entry.pack(
             fill=Tkinter.X, expand=True, **directory_opts
         )
@@ -209,7 +722,7 @@ class OTreeLauncherFrame(ttk.Frame):
             **directory_init_opts
         )
         self.opendirectory_button.pack(**directory_opts)
-        tktooltip.create_tooltip(self.opendirectory_button, "Change project")
+        tktooltip.create_tooltip(self.opendirectory_button, "Add project")
 
         self.filemanager_button = ttk.Button(
             directory_frame, text="", command=self.do_open_filemanager,
@@ -268,6 +781,36 @@ class OTreeLauncherFrame(ttk.Frame):
             self.clear_button, "Restore the database of current project"
         )
 
+        # =====================================================================
+        # SERVERS
+        # =====================================================================
+
+        servers_frame = ttk.LabelFrame(self, text="Running Servers")
+        servers_frame.pack(fill=Tkinter.X)
+
+        self.servers_tree = ttk.Treeview(
+            servers_frame, columns=("port", "pid"), height=3)
+        self.servers_tree.heading("#0", text="Project")
+        self.servers_tree.heading("port", text="Port")
+        self.servers_tree.heading("pid", text="PID")
+        self.servers_tree.column("port", width=60, stretch=False)
+        self.servers_tree.column("pid", width=60, stretch=False)
+        self.servers_tree.pack(fill=Tkinter.X, expand=True, padx=2, pady=2)
+        self.servers_tree.bind("<Double-1>", self.do_open_server)
+        tktooltip.create_tooltip(
+            self.servers_tree, "Double click to open the server in the browser"
+        )
+
+        # =====================================================================
+        # RESOURCES
+        # =====================================================================
+
+        self.resource_display = None
+        if monitor.available():
+            self.resource_display = ResourceDisplay(
+                self, text="Server Resources")
+            self.resource_display.pack(fill=Tkinter.X)
+
         # =====================================================================
         # CONSOLE
         # =====================================================================
@@ -278,25 +821,60 @@ class OTreeLauncherFrame(ttk.Frame):
         self.refresh_deploy_path()
 
     def check_connectivity(self):
-        now = time.time()
-        lstatus, ltime = self.last_connectivity_check
-        if lstatus is None or now - ltime > 60:
-            try:
-                core.check_connectivity()
-                logger.info("check_connectivity OK")
-                self.last_connectivity_check = True, now
-            except Exception as err:
-
-                logger.error(err.message)
-                self.msgbox.showerror("Critical Error", err.message)
-                self.last_connectivity_check = False, now
-        return self.last_connectivity_check[0]
+        try:
+            core.check_connectivity()
+            logger.info("check_connectivity OK")
+            return True
+        except Exception as err:
+            logger.error(err.message)
+            self.msgbox.showerror("Critical Error", err.message)
+            return False
 
     def check_launcher_enviroment(self):
         """Check the launcher enviroment and stop the program if its impossible
-        to configure or run"""
+        to configure or run.
+
+        All the checks run at the same time in background threads, each one
+        with its own timeout, and their results are handled in the Tk thread
+        as they arrive, so the window is usable meanwhile.
 
-        py_allowed, pyver_info, pyexe = core.check_py_version()
+        """
+        checks = [
+            ("python", core.check_py_version, self.preflight_python,
+             PREFLIGHT_TIMEOUT),
+            ("path", core.check_our_path, self.preflight_path,
+             PREFLIGHT_TIMEOUT),
+            ("connectivity", core.check_connectivity,
+             self.preflight_connectivity, cons.CONNECTIVITY_DEADLINE + 1),
+        ]
+        self.preflight = dict.fromkeys(name for name, _, _, _ in checks)
+        for name, func, handler, timeout in checks:
+            self.dispatcher.submit(
+                func, timeout=timeout,
+                callback=functools.partial(
+                    self.preflight_done, name, handler, True),
+                errback=functools.partial(
+                    self.preflight_done, name, handler, False)
+            )
+        self.dispatcher.submit(
+            core.check_upgrade, timeout=cons.UPGRADE_TIMEOUT + 1,
+            callback=self.notify_upgrade, errback=self.upgrade_failed
+        )
+
+    def preflight_done(self, name, handler, ok, value):
+        """Store the result of the preflight check *name* and start the
+        first run setup when all the checks passed
+
+        """
+        self.preflight[name] = handler(ok, value)
+        if all(self.preflight.values()) and not (
+                self.conf.virtualenv and core.venv_ok()):
+            self.first_run_setup()
+
+    def preflight_python(self, ok, value):
+        py_allowed, pyver_info, pyexe = (
+            value if ok else (False, unicode(value), sys.executable)
+        )
         logger.info("Python: {} ({})".format(pyver_info, pyexe))
         if not py_allowed:
             msg = (
@@ -305,35 +883,10 @@ class OTreeLauncherFrame(ttk.Frame):
             ).format(pyver_info, pyexe)
             self.msgbox.showerror("Python Version Problem", msg)
             sys.exit(1)
+        return True
 
-        if self.check_connectivity():
-            last_ver, is_new, mandatory = core.check_upgrade()
-            if mandatory:
-                msg = (
-                    "Your version of oTree-Launcher ({}) is obsolete\n"
-                    "Do you want to download new {} version?"
-                ).format(cons.STR_VERSION, last_ver)
-                response = self.msgbox.askokcancel(
-                    message=msg, icon='question',
-                    title='Version Obsolete'
-                )
-                if response:
-                    webbrowser.open(cons.OTREE_LAUNCHER_ZIP_URL)
-                sys.exit(1)
-
-            elif is_new:
-                msg = (
-                    "A new version of oTree-Launcher is available ({})\n"
-                    "Do you want to download it?"
-                ).format(last_ver)
-                response = self.msgbox.askyesno(
-                    message=msg, icon='question',
-                    title='New Version Available'
-                )
-                if response:
-                    webbrowser.open(cons.OTREE_LAUNCHER_ZIP_URL)
-
-        if not core.check_our_path():
+    def preflight_path(self, ok, value):
+        if not (ok and value):
             msg = (
                 "We found an space, unicode or invalid character in the path "
                 "where oTree-Launcher is located.\n"
@@ -343,31 +896,89 @@ class OTreeLauncherFrame(ttk.Frame):
             ).format(cons.OUR_PATH)
             self.msgbox.showerror("Path Problem", msg)
             sys.exit(1)
+        return True
+
+    def preflight_connectivity(self, ok, value):
+        if ok:
+            logger.info("check_connectivity OK")
+            return True
+        message = getattr(value, "message", None) or unicode(value)
+        venv_ready = self.conf.virtualenv and core.venv_ok()
+        if venv_ready or core.offline_setup_possible():
+            logger.warning(message)
+            return True
+        logger.error(message)
+        self.msgbox.showerror("Critical Error", message)
+        if not self.conf.virtualenv:
+            sys.exit(1)
+        return False
 
-        elif not self.conf.virtualenv:
+    def first_run_setup(self):
 
-            def clean():
-                self.conf.virtualenv = True
-                self.conf.save()
-                self.refresh_deploy_path()
+        def clean():
+            self.conf.virtualenv = True
+            self.conf.save()
+            self.refresh_deploy_path()
 
+        if self.conf.virtualenv:
+            msg = (
+                "The oTree virtualenv is missing or broken.\n"
+                "It will be rebuilt now.\n"
+            )
+        else:
             msg = (
                 "This is your first time running the oTree launcher.\n"
                 "Initial setup may take a few minutes.\n"
             )
-            self.msgbox.showinfo("First run setup", msg)
-            self.proc = core.create_virtualenv()
+        self.msgbox.showinfo("First run setup", msg)
+        self.proc = core.create_virtualenv()
+
+        setup_complete_msg = (
+            "Initial setup complete.\n"
+            "Click on the 'Deploys' menu to create a new deploy."
+        )
+
+        self.check_proc_end(clean, setup_complete_msg,
+                            popup=True, exit_on_fail=True)
+
+    def notify_upgrade(self, upgrade):
+        """Ask the user to download a new version if the upgrade is
+        mandatory or if it is a new one never notified before
 
-            setup_complete_msg = (
-                "Initial setup complete.\n"
-                "Click on the 'Deploys' menu to create a new deploy."
+        """
+        last_ver, is_new, mandatory, notified = upgrade
+        if mandatory:
+            msg = (
+                "Your version of oTree-Launcher ({}) is obsolete\n"
+                "Do you want to download new {} version?"
+            ).format(cons.str_version(), last_ver)
+            response = self.msgbox.askokcancel(
+                message=msg, icon='question',
+                title='Version Obsolete'
             )
+            if response:
+                webbrowser.open(cons.OTREE_LAUNCHER_ZIP_URL)
+            sys.exit(1)
 
-            self.check_proc_end(clean, setup_complete_msg,
-                                popup=True, exit_on_fail=True)
+        elif is_new and not notified:
+            msg = (
+                "A new version of oTree-Launcher is available ({})\n"
+                "Do you want to download it?"
+            ).format(last_ver)
+            response = self.msgbox.askyesno(
+                message=msg, icon='question',
+                title='New Version Available'
+            )
+            core.set_upgrade_notified(last_ver)
+            if response:
+                webbrowser.open(cons.OTREE_LAUNCHER_ZIP_URL)
+
+    def upgrade_failed(self, err):
+        logger.warning("Can't check for upgrades: {}".format(err))
 
     def refresh_deploy_path(self):
-        """Enable or disabled the controls if some path is selected or not
+        """Enable or disabled the controls if some path is selected or not,
+        if its server is running and if other task is running
 
         """
         if self.conf.path and not os.path.isdir(self.conf.path):
@@ -375,46 +986,93 @@ class OTreeLauncherFrame(ttk.Frame):
             self.conf.save()
 
         self.deploy_path.set(self.conf.path or "")
-        state = Tkinter.NORMAL if self.conf.path else Tkinter.DISABLED
-        self.run_button.config(state=state)
-        self.terminal_button.config(state=state)
-        self.filemanager_button.config(state=state)
-        self.clear_button.config(state=state)
+        self.deploy_entry.config(values=[
+            deploy.path for deploy in db.deploys()
+            if os.path.isdir(deploy.path)
+        ])
+
+        def state(enabled):
+            return Tkinter.NORMAL if enabled else Tkinter.DISABLED
+
+        idle = self.proc is None
+        selected = bool(self.conf.path)
+        running = selected and self.conf.path in self.servers
+        stopping = running and self.servers.get(self.conf.path).stopping
+        can_run = idle and selected and not running
+        self.run_button.config(state=state(can_run))
+        self.stop_button.config(state=state(running and not stopping))
+        self.clear_button.config(state=state(can_run))
+        self.terminal_button.config(state=state(selected))
+        self.filemanager_button.config(state=state(selected))
+
+        can_change = idle and self.conf.virtualenv
+        self.deploy_menu.entryconfig(0, state=state(can_change))
+        self.opendirectory_button.config(state=state(can_change))
+        self.deploy_entry.config(
+            state="readonly" if can_change else Tkinter.DISABLED)
+
+        self.refresh_servers()
+
+    def refresh_servers(self):
+        """Show the running servers and the resources of the selected one"""
+        running = collections.OrderedDict(
+            (server.path, server) for server in self.servers.running())
+        for iid in self.servers_tree.get_children():
+            if iid not in running:
+                self.servers_tree.delete(iid)
+        for path, server in running.items():
+            values = (
+                server.port,
+                "stopping" if server.stopping else server.proc.pid or ""
+            )
+            if self.servers_tree.exists(path):
+                self.servers_tree.item(path, values=values)
+            else:
+                self.servers_tree.insert(
+                    "", Tkinter.END, iid=path, text=path, values=values)
 
-        state = Tkinter.NORMAL if self.conf.virtualenv else Tkinter.DISABLED
-        self.deploy_menu.entryconfig(0, state=state)
-        self.opendirectory_button.config(state=state)
+        if self.resource_display is not None:
+            server = running.get(self.conf.path)
+            if server is not None and server.sampler is not None:
+                self.resource_display.attach(server.sampler)
+            else:
+                self.resource_display.detach()
 
     def check_proc_end(self, cleaner, msg, popup=False, exit_on_fail=False):
-        """Check if the process already end, or call this methos again 1 second
-        later. When the proc is finished execute the *cleaner* functiona and
+        """Wait in a background thread for the end of the current process.
+        When the proc is finished execute the *cleaner* functiona and
         print the msg to the logger and if popup is True show the same message
         as popup. If the process fails and exit_on_fail is true, stop the
         program with the error code from the subprocess
 
         """
-        if self.proc and self.proc.poll() is None:
-            self.root.after(1000, self.check_proc_end, cleaner,
-                            msg, popup, exit_on_fail)
+        proc = self.proc
+        self.dispatcher.submit(
+            proc.wait, callback=functools.partial(
+                self.proc_ended, proc, cleaner, msg, popup, exit_on_fail)
+        )
+
+    def proc_ended(self, proc, cleaner, msg, popup, exit_on_fail, code):
+        if proc is not self.proc:
+            return  # already stopped or replaced
+        if code == 0:
+            self.proc = None
+            cleaner()
+            logger.info(msg)
+            if popup:
+                self.msgbox.showinfo("Finished!", msg)
+        elif not exit_on_fail:
+            self.proc = None
+            cleaner()
+            msg = "Something gone wrong!!! Please check the console"
+            logger.critical(msg)
+            if popup:
+                self.msgbox.showerror("Error", msg)
         else:
-            if self.proc.returncode == 0:
-                self.proc = None
-                cleaner()
-                logger.info(msg)
-                if popup:
-                    self.msgbox.showinfo("Finished!", msg)
-            elif not exit_on_fail:
-                self.proc = None
-                cleaner()
-                msg = "Something gone wrong!!! Please check the console"
-                logger.critical(msg)
-                if popup:
-                    self.msgbox.showerror("Error", msg)
-            else:
-                msg = "Critical Error!!!\nThe oTree-Launcher will be closed"
-                logger.critical(msg)
-                self.msgbox.showerror("Critical Error", msg)
-                sys.exit(self.proc.returncode)
+            msg = "Critical Error!!!\nThe oTree-Launcher will be closed"
+            logger.critical(msg)
+            self.msgbox.showerror("Critical Error", msg)
+            sys.exit(code)
 
     # =========================================================================
     # SLOTS
@@ -441,10 +1099,7 @@ class OTreeLauncherFrame(ttk.Frame):
         if res:
 
             def clean():
-                self.run_button.config(state=Tkinter.NORMAL)
-                self.clear_button.config(state=Tkinter.NORMAL)
-                self.opendirectory_button.config(state=Tkinter.NORMAL)
-                self.deploy_menu.entryconfig(0, state=Tkinter.NORMAL)
+                self.refresh_deploy_path()
 
             try:
                 self.run_button.config(state=Tkinter.DISABLED)
@@ -459,48 +1114,76 @@ class OTreeLauncherFrame(ttk.Frame):
 
     def do_run(self):
         try:
-            self.run_button.config(state=Tkinter.DISABLED)
-            self.clear_button.config(state=Tkinter.DISABLED)
-            self.opendirectory_button.config(state=Tkinter.DISABLED)
-            self.deploy_menu.entryconfig(0, state=Tkinter.DISABLED)
-            self.proc = core.runserver(self.conf.path)
+            server = self.servers.start(self.conf.path)
         except Exception as err:
-            self.run_button.config(state=Tkinter.NORMAL)
-            self.clear_button.config(state=Tkinter.NORMAL)
-            self.opendirectory_button.config(state=Tkinter.NORMAL)
-            self.deploy_menu.entryconfig(0, state=Tkinter.NORMAL)
-            self.stop_button.config(state=Tkinter.DISABLED)
             self.msgbox.showerror("Something gone wrong", unicode(err))
         else:
-            logger.info("Launching web browser...")
-            self.root.after(
-                WEB_BROWSER_WAIT, webbrowser.open_new_tab,
-                cons.DEFAULT_OTREE_DEMO_URL
+            self.dispatcher.submit(
+                server.wait_ready,
+                callback=functools.partial(self.server_ready, server)
+            )
+            if self.resource_display is not None:
+                server.sampler = monitor.ResourceSampler(server.proc).start()
+            self.dispatcher.submit(
+                server.proc.wait,
+                callback=functools.partial(self.server_ended, server)
             )
-            self.check_proc_end(self.do_stop, "Server Killed")
-            self.stop_button.config(state=Tkinter.NORMAL)
+        self.refresh_deploy_path()
+
+    def server_ready(self, server, elapsed):
+        if elapsed is not None and self.servers.get(server.path) is server:
+            logger.info("Launching web browser...")
+            webbrowser.open_new_tab(server.url)
+
+    def server_ended(self, server, code):
+        if server.stopping:
+            return  # see server_stopped
+        if self.servers.discard(server):
+            logger.critical(
+                "Server of '{}' ended with code {}".format(server.path, code))
+        self.refresh_deploy_path()
 
     def do_stop(self):
-        if self.proc:
-            logger.info("Killing process...")
-            if self.proc.poll() is None:
-                core.kill_proc(self.proc)
-            self.proc = None
-        self.run_button.config(state=Tkinter.NORMAL)
-        self.clear_button.config(state=Tkinter.NORMAL)
-        self.opendirectory_button.config(state=Tkinter.NORMAL)
-        self.deploy_menu.entryconfig(0, state=Tkinter.NORMAL)
-        self.stop_button.config(state=Tkinter.DISABLED)
+        server = self.servers.get(self.conf.path)
+        if server is not None and not server.stopping:
+            logger.info("Stopping server of '{}'...".format(server.path))
+            server.stopping = True
+            stopped = functools.partial(self.server_stopped, server)
+            self.dispatcher.submit(
+                self.servers.stop, args=(server.path,),
+                callback=stopped, errback=stopped
+            )
+        self.refresh_deploy_path()
+
+    def server_stopped(self, server, result):
+        if isinstance(result, Exception):
+            server.stopping = False  # allow to retry
+            logger.error("Can't stop the server of '{}': {}".format(
+                server.path, result))
+        self.refresh_deploy_path()
+
+    def do_select_deploy(self, event=None):
+        path = self.deploy_path.get()
+        if path and path != self.conf.path:
+            self.conf.path = path
+            self.conf.save()
+        self.refresh_deploy_path()
+
+    def do_open_server(self, event=None):
+        for path in self.servers_tree.selection():
+            server = self.servers.get(path)
+            if server is not None:
+                webbrowser.open_new_tab(server.url)
 
     def do_about(self):
-        title = "About {} - v.{}".format(cons.PRJ, cons.STR_VERSION)
+        title = "About {} - v.{}".format(cons.PRJ, cons.str_version())
         body = (
             "{doc}\n"
             "A modern open platform for social science experiments\n"
             "Version: {version}"
         ).format(
             prj=cons.PRJ, url=cons.URL, doc=cons.DOC,
-            version=cons.STR_VERSION
+            version=cons.str_version()
         )
         self.msgbox.showinfo(title, body)
 
@@ -519,14 +1202,18 @@ class OTreeLauncherFrame(ttk.Frame):
         }
         dpath = tkFileDialog.askdirectory(**options)
 
-        if dpath and dpath != self.conf.path:
+        if dpath:
 
-            if not self.check_connectivity():
+            # an up to date deploy is reopened without network
+            inputs = core.requirements_inputs(dpath)
+            uptodate = core.is_memoized("install_requirements", dpath, inputs)
+            if not uptodate and not self.check_connectivity():
                 return
 
             def clean():
                 self.conf.path = dpath
                 self.conf.save()
+                db.get_deploy(dpath, create=True)
                 self.refresh_deploy_path()
 
             try:
@@ -536,7 +1223,7 @@ class OTreeLauncherFrame(ttk.Frame):
                 self.clear_button.config(state=Tkinter.DISABLED)
                 self.opendirectory_button.config(state=Tkinter.DISABLED)
                 self.deploy_menu.entryconfig(0, state=Tkinter.DISABLED)
-                self.proc = core.install_requirements(dpath)
+                self.proc = core.install_requirements(dpath, inputs=inputs)
                 self.check_proc_end(clean, "Virtualenv upgraded")
             except Exception as err:
                 self.msgbox.showerror("Something gone wrong", unicode(err))
@@ -590,6 +1277,7 @@ class OTreeLauncherFrame(ttk.Frame):
                     block()
                     self.conf.path = wrkpath
                     self.conf.save()
+                    db.get_deploy(wrkpath, create=True)
                     clean()
 
                 def reset():
@@ -604,7 +1292,8 @@ class OTreeLauncherFrame(ttk.Frame):
 
                 def install():
                     block()
-                    self.proc = core.install_requirements(wrkpath)
+                    self.proc = core.install_requirements(
+                        wrkpath, isolated=True)
                     self.check_proc_end(reset, "Install done")
 
                 block()
@@ -625,40 +1314,38 @@ def run():
     root = Tkinter.Tk()
     root.option_add("*tearOff", False)
 
-    with splash.Splash(root, res.get("imgs", "splash.gif"), 1):
+    # housekeeping in parallel while the splash is visible
+    startup = core.TaskRunner()
+    startup.add("clean_logs", core.clean_logs, critical=False)
+    startup.add("clean_tempdir", core.clean_tempdir)
+    startup.add("database", core.get_conf)
 
-        core.clean_logs()
-        core.clean_tempdir()
-        logfile_fp = core.logfile_fp()
+    with splash.Splash(root, res.get("imgs", "splash.gif"),
+                       cons.SPLASH_MIN_TIME,
+                       ready=startup.critical_done):
 
         root.geometry("500x530+50+50")
-        root.title("{} - v.{}".format(cons.PRJ, cons.STR_VERSION))
+        root.title("{} - v.{}".format(cons.PRJ, cons.str_version()))
 
         # set icon
         icon = Tkinter.PhotoImage(file=res.get("imgs", "otree.gif"))
         root.tk.call('wm', 'iconphoto', root._w, icon)
 
         # add main frame
-        frame = OTreeLauncherFrame(root)
+        frame = OTreeLauncherFrame(root, startup.result("database"))
         frame.pack(expand=True, fill=Tkinter.BOTH)
 
         # setup logger
+        gui_handler = LoggingToGUI(frame.log_display, frame.dispatcher)
         logger.handlers = []
-        logger.addHandler(LoggingToGUI(frame.log_display.console))
+        logger.addHandler(gui_handler)
+        logger.addHandler(core.LogWriterHandler(core.LOG_WRITER))
+        core.OUTPUT.subscribe(show_output)
 
-        if not frame.conf.virtualenv and not frame.check_connectivity():
-            sys.exit(1)
+        startup.result("clean_tempdir")
 
         logger.info("The oTree Launcher says 'Hello'")
 
-    def read_log_file():
-        line = logfile_fp.readline()
-        if line:
-            logger.info(line.rstrip())
-        root.after(10, read_log_file)
-
-    read_log_file()
-
     frame.check_launcher_enviroment()
     root.mainloop()
 
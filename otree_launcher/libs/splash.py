@@ -5,10 +5,11 @@ import time
 
 class Splash:
 
-    def __init__(self, root, file, wait):
+    def __init__(self, root, file, wait, ready=None):
         self.__root = root
         self.__file = file
-        self.__wait = wait + time.clock()
+        self.__wait = wait + time.time()
+        self.__ready = ready
 
     def __enter__(self):
         # Hide the root while it is built.
@@ -41,10 +42,12 @@ class Splash:
         self.__splash = splash
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        # Ensure that required time has passed.
-        now = time.clock()
-        if now < self.__wait:
-            time.sleep(self.__wait - now)
+        # Ensure that required time has passed and the work is ready,
+        # keeping the splash screen painted meanwhile.
+        while (time.time() < self.__wait or
+               (self.__ready is not None and not self.__ready())):
+            self.__window.update()
+            time.sleep(0.01)
         # Free used resources in reverse order.
         del self.__splash
         self.__canvas.destroy()
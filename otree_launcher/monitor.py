@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# =============================================================================
+# FUTURE
+# =============================================================================
+
+from __future__ import unicode_literals
+
+
+# =============================================================================
+# DOCS
+# =============================================================================
+
+__doc__ = """Resources used by the process group of a running server
+
+Reads /proc, so the samples are only available on Linux; on other platforms
+``available()`` is False and the sampler does nothing.
+
+"""
+
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import os
+import io
+import csv
+import time
+import threading
+import collections
+
+from . import cons
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+logger = cons.logger
+
+PROC_PATH = "/proc"
+
+FIELDS = (
+    "time", "procs", "cpu", "rss", "threads", "fds",
+    "read_bytes", "write_bytes"
+)
+
+# : One measure of the whole group. *cpu* is a percent of one core, *rss*,
+# : *read_bytes* and *write_bytes* are bytes (the io ones are cumulative)
+Sample = collections.namedtuple("Sample", FIELDS)
+
+
+# =============================================================================
+# PROC READERS
+# =============================================================================
+
+def available():
+    return os.path.isdir(os.path.join(PROC_PATH, "self"))
+
+
+def stat_fields(pid):
+    """The fields of /proc/<pid>/stat after the command name (the first
+    one is the state)
+
+    """
+    with io.open(os.path.join(PROC_PATH, str(pid), "stat"), "rb") as fp:
+        data = fp.read()
+    # the command name can contain spaces and parenthesis
+    return data[data.rindex(b")") + 2:].split()
+
+
+def read_stat(pid):
+    """Return the process group, the cpu ticks (user + system), the number
+    of threads and the rss pages of *pid* (see proc(5))
+
+    """
+    fields = stat_fields(pid)
+    return (
+        int(fields[2]), int(fields[11]) + int(fields[12]),
+        int(fields[17]), int(fields[21])
+    )
+
+
+def count_fds(pid):
+    try:
+        return len(os.listdir(os.path.join(PROC_PATH, str(pid), "fd")))
+    except OSError:
+        return 0
+
+
+def read_io(pid):
+    """Return the bytes read and written from storage by *pid*"""
+    values = {}
+    try:
+        with io.open(os.path.join(PROC_PATH, str(pid), "io"), "rb") as fp:
+            for line in fp:
+                key, _, value = line.partition(b":")
+                values[key] = int(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return values.get(b"read_bytes", 0), values.get(b"write_bytes", 0)
+
+
+def boot_time():
+    """Seconds since the epoch when the system booted (1 s precision)"""
+    with io.open(os.path.join(PROC_PATH, "stat"), "rb") as fp:
+        for line in fp:
+            if line.startswith(b"btime "):
+                return int(line.split()[1])
+    raise ValueError("No boot time in /proc/stat")
+
+
+def start_time(pid):
+    """Seconds since the epoch when *pid* started (see proc(5))"""
+    ticks = int(stat_fields(pid)[19])
+    return boot_time() + ticks / float(os.sysconf(str("SC_CLK_TCK")))
+
+
+def cmdline(pid):
+    """The arguments of *pid* (an empty list for zombies and kernel
+    threads)
+
+    """
+    with io.open(os.path.join(PROC_PATH, str(pid), "cmdline"), "rb") as fp:
+        return [arg for arg in fp.read().split(b"\0") if arg]
+
+
+def group_stats(pgid):
+    """Return a dict ``{pid: (ticks, threads, rss_pages)}`` with every
+    process of the group *pgid*
+
+    """
+    stats = {}
+    for name in os.listdir(PROC_PATH):
+        if not name.isdigit():
+            continue
+        try:
+            group, ticks, threads, rss = read_stat(name)
+        except (IOError, OSError, ValueError, IndexError):
+            continue  # ended while walking
+        if group == pgid:
+            stats[int(name)] = (ticks, threads, rss)
+    return stats
+
+
+def group_pids(pgid):
+    """The pids of the processes of the group *pgid* that are not zombies
+    (a zombie is dead even if its parent never reaps it)
+
+    """
+    pids = []
+    for name in os.listdir(PROC_PATH):
+        if not name.isdigit():
+            continue
+        try:
+            fields = stat_fields(name)
+        except (IOError, OSError, ValueError):
+            continue
+        if int(fields[2]) == pgid and fields[0] != b"Z":
+            pids.append(int(name))
+    return pids
+
+
+# =============================================================================
+# SAMPLER
+# =============================================================================
+
+class ResourceSampler(object):
+    """Sample every *interval* seconds, in a background thread, the
+    resources used by the process group of *proc* (anything with a ``pid``
+    attribute, read again on every sample so a StepRunner can be passed).
+
+    The last *size* samples are kept in the ring buffer *samples*
+
+    """
+
+    def __init__(self, proc, interval=cons.SAMPLER_INTERVAL,
+                 size=cons.SAMPLER_SIZE):
+        self.proc = proc
+        self.interval = interval
+        self.samples = collections.deque(maxlen=size)
+        self.ticks = {}
+        self.last = None
+        self._stop = threading.Event()
+        self._thread = None
+        if available():
+            self._clk_tck = float(os.sysconf(str("SC_CLK_TCK")))
+            self._page_size = os.sysconf(str("SC_PAGE_SIZE"))
+
+    def start(self):
+        if not available() or self._thread is not None:
+            return self
+        self._thread = threading.Thread(target=self._run, name="sampler")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                sample = self.sample()
+            except Exception as err:
+                logger.warning("Resource sampler stopped: {}".format(err))
+                return
+            if sample is not None:
+                self.samples.append(sample)
+            self._stop.wait(self.interval)
+
+    def sample(self):
+        """Measure the group now. Returns None if there is no process"""
+        pid = self.proc.pid
+        if not pid:
+            return None
+        now = time.time()
+        try:
+            stats = group_stats(os.getpgid(pid))
+        except OSError:  # ended
+            return None
+        if not stats:
+            return None
+
+        # cpu of the processes seen in the previous sample (or born since)
+        ticks = sum(
+            stat[0] - self.ticks.get(spid, 0) for spid, stat in stats.items()
+        )
+        elapsed = now - self.last if self.last else None
+        cpu = ticks / self._clk_tck / elapsed * 100 if elapsed else 0.
+        self.ticks = {spid: stat[0] for spid, stat in stats.items()}
+        self.last = now
+
+        read_bytes = write_bytes = fds = 0
+        for spid in stats:
+            read, written = read_io(spid)
+            read_bytes, write_bytes = read_bytes + read, write_bytes + written
+            fds += count_fds(spid)
+
+        return Sample(
+            time=now, procs=len(stats), cpu=max(0., cpu),
+            rss=sum(stat[2] for stat in stats.values()) * self._page_size,
+            threads=sum(stat[1] for stat in stats.values()), fds=fds,
+            read_bytes=read_bytes, write_bytes=write_bytes
+        )
+
+    def to_csv(self, fpath):
+        """Write all the samples in the ring buffer to *fpath*"""
+        with open(fpath, "wb") as fp:
+            writer = csv.writer(fp)
+            writer.writerow([str(field) for field in FIELDS])
+            for sample in list(self.samples):
+                writer.writerow(
+                    ["{:.3f}".format(sample.time), sample.procs,
+                     "{:.1f}".format(sample.cpu)] + list(sample[3:])
+                )
+        return len(self.samples)
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+if __name__ == "__main__":
+    print(__doc__)
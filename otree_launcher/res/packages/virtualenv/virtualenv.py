@@ -22,6 +22,13 @@ from distutils.util import strtobool
 import struct
 import subprocess
 import tarfile
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 if sys.version_info < (2, 6):
     print('ERROR: %s' % sys.exc_info()[1])
@@ -460,9 +467,12 @@ def copyfile(src, dest, symlink=True):
         # Some bad symlink in the src
         logger.warn('Cannot find file %s (bad symlink)', src)
         return
-    if os.path.exists(dest):
+    if os.path.exists(dest) or (_bulk is not None and _bulk.planned(dest)):
         logger.debug('File %s already exists', dest)
         return
+    if _bulk is not None:
+        _bulk.add(src, dest, symlink)
+        return
     if not os.path.exists(os.path.dirname(dest)):
         logger.info('Creating parent directories for %s', os.path.dirname(dest))
         os.makedirs(os.path.dirname(dest))
@@ -481,6 +491,152 @@ def copyfile(src, dest, symlink=True):
         logger.info('Copying to %s', dest)
         copyfileordir(src, dest, symlink)
 
+# Threads used by the bulk population to copy files
+BULK_WORKERS = 8
+
+# The BulkPopulation collecting the copyfile calls (None copies at once)
+_bulk = None
+
+
+class BulkPopulation(object):
+    """Plan every copyfile call first and populate them all together:
+    symlinks when allowed (as copyfile), else hardlinks, else copies in a
+    pool of threads. Directories are expanded to their files."""
+
+    def __init__(self, workers=BULK_WORKERS):
+        self.workers = workers
+        self.entries = []
+        self.dests = set()
+        self.stats = {'files': 0, 'bytes': 0, 'symlinked': 0,
+                      'hardlinked': 0, 'copied': 0}
+        self._no_link = set()  # (src device, dest device) without hardlinks
+        self._lock = threading.Lock()
+
+    def add(self, src, dest, symlink):
+        self.dests.add(os.path.abspath(dest))
+        self.entries.append((src, dest, symlink))
+
+    def planned(self, dest):
+        """True if dest or one of its parent directories is planned (so
+        would exist when copied at once)"""
+        dest = os.path.abspath(dest)
+        while dest not in self.dests:
+            parent = os.path.dirname(dest)
+            if parent == dest:
+                return False
+            dest = parent
+        return True
+
+    def _count(self, kind, size):
+        self._lock.acquire()
+        try:
+            self.stats['files'] += 1
+            self.stats['bytes'] += size
+            self.stats[kind] += 1
+        finally:
+            self._lock.release()
+
+    def _link(self, src, dest):
+        """Hardlink a file; False if the filesystem does not allow it"""
+        if not hasattr(os, 'link'):
+            return False
+        devices = (os.stat(src).st_dev, os.stat(os.path.dirname(dest)).st_dev)
+        if devices in self._no_link:
+            return False
+        try:
+            os.link(src, dest)
+        except OSError:
+            self._no_link.add(devices)
+            return False
+        return True
+
+    def _place(self, src, dest, symlink, copies):
+        """Symlink or hardlink *src* now or leave it in *copies*"""
+        if symlink and os.path.islink(src) and hasattr(os, 'symlink'):
+            os.symlink(os.readlink(src), dest)
+            self._count('symlinked', 0)
+        elif os.path.isdir(src):
+            # as shutil.copytree, but every file populated on its own
+            mkdir(dest)
+            for name in os.listdir(src):
+                self._place(join(src, name), join(dest, name), symlink, copies)
+        elif self._link(os.path.realpath(src), dest):
+            self._count('hardlinked', os.path.getsize(dest))
+        else:
+            copies.put((src, dest))
+
+    def _copy(self, copies, errors):
+        while True:
+            try:
+                src, dest = copies.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                shutil.copy2(src, dest)
+                self._count('copied', os.path.getsize(dest))
+            except Exception:
+                errors.append(sys.exc_info()[1])
+
+    def run(self):
+        start = time.time()
+        copies = queue.Queue()
+        for src, dest, symlink in self.entries:
+            if not os.path.exists(os.path.dirname(dest)):
+                logger.info('Creating parent directories for %s',
+                            os.path.dirname(dest))
+                os.makedirs(os.path.dirname(dest))
+            if os.path.islink(src):
+                srcpath = os.readlink(src)
+            else:
+                srcpath = os.path.abspath(src)
+            if symlink and hasattr(os, 'symlink') and not is_win:
+                logger.info('Symlinking %s', dest)
+                try:
+                    os.symlink(srcpath, dest)
+                    self._count('symlinked', 0)
+                    continue
+                except (OSError, NotImplementedError):
+                    logger.info('Symlinking failed, populating %s', dest)
+            self._place(src, dest, symlink, copies)
+        errors = []
+        threads = []
+        for i in range(min(self.workers, copies.qsize())):
+            thread = threading.Thread(target=self._copy, args=(copies, errors))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        self.stats['seconds'] = elapsed = max(time.time() - start, 1e-6)
+        logger.notify(
+            'Populated %s files (%s bytes) in %.3fs: %.0f files/s, %.1f MB/s '
+            '(%s symlinked, %s hardlinked, %s copied)' % (
+                self.stats['files'], self.stats['bytes'], elapsed,
+                self.stats['files'] / elapsed,
+                self.stats['bytes'] / elapsed / 1024 / 1024,
+                self.stats['symlinked'], self.stats['hardlinked'],
+                self.stats['copied']))
+        return self.stats
+
+
+def copy_executables(pairs, bulk=False):
+    """Copy the interpreter files of the (src, dest) *pairs*; with *bulk*
+    populate them together as BulkPopulation does (hardlinked when the
+    filesystem allows it). An existing dest is removed first so the source
+    is never written through a link."""
+    if not bulk:
+        for src, dest in pairs:
+            shutil.copyfile(src, dest)
+        return
+    plan = BulkPopulation()
+    for src, dest in pairs:
+        if os.path.lexists(dest):
+            os.unlink(dest)
+        plan.add(src, dest, False)
+    plan.run()
+
+
 def writefile(dest, content, overwrite=True):
     if not os.path.exists(dest):
         logger.info('Writing %s', dest)
@@ -697,6 +853,13 @@ def main():
         default=True,
         help="Always copy files rather than symlinking.")
 
+    parser.add_option(
+        '--bulk',
+        dest='bulk',
+        action='store_true',
+        help="Plan all the copies of the interpreter files first and populate "
+             "them together (hardlinks where possible, else parallel copies).")
+
     parser.add_option(
         '--unzip-setuptools',
         dest='unzip_setuptools',
@@ -822,7 +985,8 @@ def main():
                        never_download=True,
                        no_setuptools=options.no_setuptools,
                        no_pip=options.no_pip,
-                       symlink=options.symlink)
+                       symlink=options.symlink,
+                       bulk=options.bulk)
     if 'after_install' in globals():
         after_install(options, home_dir)
 
@@ -968,7 +1132,8 @@ def install_wheel(project_names, py_executable, search_dirs=None):
 def create_environment(home_dir, site_packages=False, clear=False,
                        unzip_setuptools=False,
                        prompt=None, search_dirs=None, never_download=False,
-                       no_setuptools=False, no_pip=False, symlink=True):
+                       no_setuptools=False, no_pip=False, symlink=True,
+                       bulk=False):
     """
     Creates a new environment in ``home_dir``.
 
@@ -977,12 +1142,16 @@ def create_environment(home_dir, site_packages=False, clear=False,
 
     If ``clear`` is true (default False) then the environment will
     first be cleared.
+
+    If ``bulk`` is true the interpreter files are populated together
+    (see ``BulkPopulation``).
     """
     home_dir, lib_dir, inc_dir, bin_dir = path_locations(home_dir)
 
     py_executable = os.path.abspath(install_python(
         home_dir, lib_dir, inc_dir, bin_dir,
-        site_packages=site_packages, clear=clear, symlink=symlink))
+        site_packages=site_packages, clear=clear, symlink=symlink,
+        bulk=bulk))
 
     install_distutils(home_dir)
 
@@ -1136,8 +1305,9 @@ def subst_path(prefix_path, prefix, home_dir):
     return prefix_path.replace(prefix, home_dir, 1)
 
 
-def install_python(home_dir, lib_dir, inc_dir, bin_dir, site_packages, clear, symlink=True):
+def install_python(home_dir, lib_dir, inc_dir, bin_dir, site_packages, clear, symlink=True, bulk=False):
     """Install just the base environment, no distutils patches etc"""
+    global _bulk
     if sys.executable.startswith(bin_dir):
         print('Please use the *system* python to run this script')
         return
@@ -1168,6 +1338,8 @@ def install_python(home_dir, lib_dir, inc_dir, bin_dir, site_packages, clear, sy
     else:
         logger.info('Copying Python bootstrap modules')
     logger.indent += 2
+    if bulk:
+        _bulk = BulkPopulation()
     try:
         # copy required files...
         for stdlib_dir in stdlib_dirs:
@@ -1179,7 +1351,10 @@ def install_python(home_dir, lib_dir, inc_dir, bin_dir, site_packages, clear, sy
                     copyfile(join(stdlib_dir, fn), join(lib_dir, fn), symlink)
         # ...and modules
         copy_required_modules(home_dir, symlink)
+        if bulk:
+            _bulk.run()
     finally:
+        _bulk = None
         logger.indent -= 2
     mkdir(join(lib_dir, 'site-packages'))
     import site
@@ -1271,21 +1446,24 @@ def install_python(home_dir, lib_dir, inc_dir, bin_dir, site_packages, clear, sy
             logger.info('Deleting %s (not Windows env or not build directory python)' % pyd_pth)
             os.unlink(pyd_pth)
 
+    # the framework builds patch the interpreter copy in place, so it can't
+    # be a hardlink
+    link_executables = bulk and '.framework' not in prefix
+
     if sys.executable != py_executable:
         ## FIXME: could I just hard link?
         executable = sys.executable
-        shutil.copyfile(executable, py_executable)
-        make_exe(py_executable)
+        executables = [(executable, py_executable)]
         if is_win or is_cygwin:
             pythonw = os.path.join(os.path.dirname(sys.executable), 'pythonw.exe')
             if os.path.exists(pythonw):
                 logger.info('Also created pythonw.exe')
-                shutil.copyfile(pythonw, os.path.join(os.path.dirname(py_executable), 'pythonw.exe'))
+                executables.append((pythonw, os.path.join(os.path.dirname(py_executable), 'pythonw.exe')))
             python_d = os.path.join(os.path.dirname(sys.executable), 'python_d.exe')
             python_d_dest = os.path.join(os.path.dirname(py_executable), 'python_d.exe')
             if os.path.exists(python_d):
                 logger.info('Also created python_d.exe')
-                shutil.copyfile(python_d, python_d_dest)
+                executables.append((python_d, python_d_dest))
             elif os.path.exists(python_d_dest):
                 logger.info('Removed python_d.exe as it is no longer at the source')
                 os.unlink(python_d_dest)
@@ -1300,13 +1478,15 @@ def install_python(home_dir, lib_dir, inc_dir, bin_dir, site_packages, clear, sy
             pythondll_d_dest = os.path.join(os.path.dirname(py_executable), py_executable_dll_d)
             if os.path.exists(pythondll):
                 logger.info('Also created %s' % py_executable_dll)
-                shutil.copyfile(pythondll, os.path.join(os.path.dirname(py_executable), py_executable_dll))
+                executables.append((pythondll, os.path.join(os.path.dirname(py_executable), py_executable_dll)))
             if os.path.exists(pythondll_d):
                 logger.info('Also created %s' % py_executable_dll_d)
-                shutil.copyfile(pythondll_d, pythondll_d_dest)
+                executables.append((pythondll_d, pythondll_d_dest))
             elif os.path.exists(pythondll_d_dest):
                 logger.info('Removed %s as the source does not exist' % pythondll_d_dest)
                 os.unlink(pythondll_d_dest)
+        copy_executables(executables, link_executables)
+        make_exe(py_executable)
         if is_pypy:
             # make a symlink python --> pypy-c
             python_executable = os.path.join(os.path.dirname(py_executable), 'python')
@@ -1344,7 +1524,8 @@ def install_python(home_dir, lib_dir, inc_dir, bin_dir, site_packages, clear, sy
                         % (expected_exe, secondary_exe, py_executable))
         else:
             logger.notify('Also creating executable in %s' % secondary_exe)
-            shutil.copyfile(sys.executable, secondary_exe)
+            copy_executables([(sys.executable, secondary_exe)],
+                             link_executables)
             make_exe(secondary_exe)
 
     if '.framework' in prefix:
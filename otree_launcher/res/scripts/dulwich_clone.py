@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# =============================================================================
+# DOC
+# =============================================================================
+
+"""Clone a single branch or tag of a git repository with dulwich
+
+Only the objects reachable from the selected ref are fetched: the dulwich
+installed in the launcher virtualenv can't make shallow clones, so the
+whole history of that ref is received (but not the one of the other
+branches). Runs inside the launcher virtualenv when git is not available.
+
+"""
+
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import os
+import sys
+import argparse
+
+from dulwich.client import get_transport_and_path
+from dulwich.repo import Repo
+
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+def select_ref(refs, branch=None, tag=None):
+    """Return the name of the ref to create, the sha to fetch and the sha
+    of the commit to check out from the advertised *refs*.
+
+    Without *branch* nor *tag* is the branch pointed by the remote HEAD
+
+    """
+    if tag:
+        name = "refs/tags/" + tag
+        if name not in refs:
+            raise LookupError("Tag '{}' not found".format(tag))
+        return name, refs[name], refs.get(name + "^{}", refs[name])
+    if branch:
+        name = "refs/heads/" + branch
+        if name not in refs:
+            raise LookupError("Branch '{}' not found".format(branch))
+        return name, refs[name], refs[name]
+    head = refs["HEAD"]
+    names = sorted(
+        name for name, sha in refs.items()
+        if name.startswith("refs/heads/") and sha == head
+    )
+    if "refs/heads/master" in names:
+        names.insert(0, "refs/heads/master")
+    return (names[0] if names else None), head, head
+
+
+def clone(source, target, branch=None, tag=None, outstream=sys.stdout):
+    """Clone the *branch* or the *tag* of *source* into *target*"""
+    client, host_path = get_transport_and_path(source)
+    if not os.path.exists(target):
+        os.mkdir(target)
+    repo = Repo.init(target)
+
+    selected = []
+
+    def determine_wants(refs):
+        selected.extend(select_ref(refs, branch, tag))
+        return [selected[1]]
+
+    fp, commit, abort = repo.object_store.add_pack()
+    try:
+        client.fetch_pack(
+            host_path, determine_wants, repo.get_graph_walker(), fp.write,
+            outstream.write)
+    except:
+        abort()
+        raise
+    else:
+        commit()
+    name, sha, checkout = selected
+
+    config = repo.get_config()
+    config.set(("remote", "origin"), "url", source)
+    if name and name.startswith("refs/heads/"):
+        local = name[len("refs/heads/"):]
+        config.set(
+            ("remote", "origin"), "fetch",
+            "+{}:refs/remotes/origin/{}".format(name, local))
+        config.set(("branch", local), "remote", "origin")
+        config.set(("branch", local), "merge", name)
+        repo.refs["refs/remotes/origin/" + local] = sha
+        repo.refs[name] = sha
+        repo.refs.set_symbolic_ref("HEAD", name)
+    else:
+        if name:
+            repo.refs[name] = sha
+        # detached: setting HEAD would follow it to refs/heads/master
+        repo.refs.remove_if_equals("HEAD", None)
+        repo.refs.add_if_new("HEAD", checkout)
+    config.write_to_path()
+
+    outstream.write("Checking out {}\n".format(checkout))
+    repo.reset_index()
+    return repo
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("source")
+    parser.add_argument("target")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--branch")
+    group.add_argument("--tag")
+    args = parser.parse_args(argv)
+    try:
+        clone(args.source, args.target, args.branch, args.tag)
+    except LookupError as err:
+        sys.stderr.write("{}\n".format(err))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())